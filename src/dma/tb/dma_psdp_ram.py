@@ -10,6 +10,10 @@ Authors:
 """
 
 import logging
+import mmap
+import os
+from array import array
+from collections import deque
 from typing import NamedTuple
 
 import cocotb
@@ -18,9 +22,266 @@ from cocotb.triggers import Event, RisingEdge
 from cocotb_bus.bus import Bus
 
 from cocotbext.axi.memory import Memory
+from cocotbext.axi.sparse_memory import SparseMemory
+from cocotbext.axi.utils import hexdump, hexdump_lines, hexdump_str
 from cocotbext.axi import Region
 
 
+def _byte_be_runs(be):
+    runs = []
+    start = None
+    for k in range(9):
+        if k < 8 and be & (1 << k):
+            if start is None:
+                start = k
+        elif start is not None:
+            runs.append((start, k))
+            start = None
+    return tuple(runs)
+
+
+# contiguous (start, stop) byte runs for each 8-bit byte enable value
+_be_byte_runs = [_byte_be_runs(x) for x in range(256)]
+
+
+def be_runs(be):
+    # contiguous (start, stop) byte runs in a byte enable mask
+    runs = []
+    offset = 0
+    while be:
+        for start, stop in _be_byte_runs[be & 0xff]:
+            if runs and runs[-1][1] == start+offset:
+                runs[-1] = (runs[-1][0], stop+offset)
+            else:
+                runs.append((start+offset, stop+offset))
+        be >>= 8
+        offset += 8
+    return runs
+
+
+class PagedMemory(SparseMemory):
+    # sparse memory made of 4 KB pages, allocated on first write, with a
+    # fast path for accesses within a single page (i.e. segment words)
+
+    def read(self, address, length, **kwargs):
+        block_offset = address & 0xfff
+        if 0 <= address < self.size and 0 <= length and block_offset+length <= 4096 and address+length <= self.size:
+            block = self.segs.get(address - block_offset)
+            if block is None:
+                return bytes(length)
+            return bytes(block[block_offset:block_offset+length])
+        return super().read(address, length, **kwargs)
+
+    def write(self, address, data, **kwargs):
+        block_offset = address & 0xfff
+        length = len(data)
+        if 0 <= address < self.size and block_offset+length <= 4096 and address+length <= self.size:
+            block_addr = address - block_offset
+            block = self.segs.get(block_addr)
+            if block is None:
+                block = bytearray(4096)
+                self.segs[block_addr] = block
+            block[block_offset:block_offset+length] = data
+            return
+        super().write(address, data, **kwargs)
+
+
+class MmapMemory:
+    # memory backed by an mmap of a file, which is extended (sparsely, on
+    # most filesystems) to size; call close() or use as a context manager
+
+    def __init__(self, size, file):
+        self.size = size
+        self.fd = os.open(file, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.mmap = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def read(self, address, length, **kwargs):
+        if address < 0 or address >= self.size:
+            raise ValueError("address out of range")
+        if length < 0:
+            raise ValueError("invalid length")
+        if address+length > self.size:
+            raise ValueError("operation out of range")
+        return self.mmap[address:address+length]
+
+    def write(self, address, data, **kwargs):
+        if address < 0 or address >= self.size:
+            raise ValueError("address out of range")
+        if address+len(data) > self.size:
+            raise ValueError("operation out of range")
+        self.mmap[address:address+len(data)] = bytes(data)
+
+    def clear(self):
+        # punch out the file contents
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, self.size)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def hexdump(self, address, length, prefix=""):
+        hexdump(self.read(address, length), prefix=prefix, offset=address)
+
+    def hexdump_lines(self, address, length, prefix=""):
+        return hexdump_lines(self.read(address, length), prefix=prefix, offset=address)
+
+    def hexdump_str(self, address, length, prefix=""):
+        return hexdump_str(self.read(address, length), prefix=prefix, offset=address)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.mmap[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = bytes(value)
+        self.mmap[key] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PauseMixin:
+    # pause control shared by the RAM models; a list, tuple, bytes, or array
+    # is a cyclic pattern stepped once per clock by _step_pause() in the
+    # model's main loop, any other iterable runs in a separate coroutine
+
+    def _init_pause(self):
+        self.pause = False
+        self._pause_generator = None
+        self._pause_pattern = None
+        self._pause_index = 0
+        self._pause_cr = None
+
+    def set_pause_generator(self, generator=None):
+        if self._pause_cr is not None:
+            self._pause_cr.kill()
+            self._pause_cr = None
+
+        self._pause_generator = None
+        self._pause_pattern = None
+
+        if callable(generator):
+            generator = generator()
+
+        if isinstance(generator, (list, tuple, bytes, bytearray, array)):
+            if generator:
+                self._pause_pattern = [bool(x) for x in generator]
+                self._pause_index = 0
+                self.pause = self._pause_pattern[0]
+        elif generator is not None:
+            self._pause_generator = generator
+            self._pause_cr = cocotb.start_soon(self._run_pause())
+
+    def clear_pause_generator(self):
+        self.set_pause_generator(None)
+
+    def _step_pause(self):
+        if self._pause_pattern is not None:
+            self._pause_index += 1
+            if self._pause_index >= len(self._pause_pattern):
+                self._pause_index = 0
+            self.pause = self._pause_pattern[self._pause_index]
+
+    async def _run_pause(self):
+        clock_edge_event = RisingEdge(self.clock)
+
+        for val in self._pause_generator:
+            self.pause = val
+            await clock_edge_event
+
+
+class PsdpRamMonitor:
+    # per-segment command, stall, byte, and outstanding counters
+
+    def __init__(self, name, seg_count, seg_byte_lanes, log):
+        self.name = name
+        self.seg_count = seg_count
+        self.seg_byte_lanes = seg_byte_lanes
+        self.seg_be_mask = 2**seg_byte_lanes-1
+        self.log = log
+
+        self.clear()
+
+    def clear(self):
+        self.cycles = 0
+        self.cmd_beats = [0]*self.seg_count
+        self.stall_cycles = [0]*self.seg_count
+        self.resp_beats = [0]*self.seg_count
+        self.bytes = [0]*self.seg_count
+        self.outstanding = [0]*self.seg_count
+        self.max_outstanding = [0]*self.seg_count
+        # cycles by number of segments accepting a command
+        self.active_hist = [0]*(self.seg_count+1)
+
+    def sample(self, cmd_valid, cmd_ready, resp=0, cmd_be=None):
+        # bytes are counted from cmd_be if provided, otherwise as full words per response
+        cmd = cmd_valid & cmd_ready
+        stall = cmd_valid & ~cmd_ready
+
+        self.cycles += 1
+        self.active_hist[bin(cmd).count('1')] += 1
+
+        if not cmd_valid and not resp:
+            return
+
+        for seg in range(self.seg_count):
+            seg_mask = 1 << seg
+
+            if cmd & seg_mask:
+                self.cmd_beats[seg] += 1
+                self.outstanding[seg] += 1
+                if self.outstanding[seg] > self.max_outstanding[seg]:
+                    self.max_outstanding[seg] = self.outstanding[seg]
+                if cmd_be is not None:
+                    self.bytes[seg] += bin((cmd_be >> self.seg_byte_lanes*seg) & self.seg_be_mask).count('1')
+            elif stall & seg_mask:
+                self.stall_cycles[seg] += 1
+
+            if resp & seg_mask:
+                self.resp_beats[seg] += 1
+                if self.outstanding[seg]:
+                    self.outstanding[seg] -= 1
+                if cmd_be is None:
+                    self.bytes[seg] += self.seg_byte_lanes
+
+    def summary(self):
+        cycles = max(self.cycles, 1)
+        lines = [f"{self.name} segment monitor: {self.cycles} cycles"]
+
+        for seg in range(self.seg_count):
+            lines.append(f"  seg {seg}: {self.cmd_beats[seg]} cmd beats ({self.cmd_beats[seg]*100/cycles:.1f}% util), "
+                f"{self.stall_cycles[seg]} stall cycles ({self.stall_cycles[seg]*100/cycles:.1f}%), "
+                f"{self.resp_beats[seg]} resp beats, {self.bytes[seg]} bytes, "
+                f"{self.outstanding[seg]} outstanding (max {self.max_outstanding[seg]})")
+
+        lines.append("  segments accepting a command per cycle:")
+        for k, count in enumerate(self.active_hist):
+            lines.append(f"    {k}: {count:10d} ({count*100/cycles:5.1f}%) {'#'*(count*50//cycles)}")
+
+        return lines
+
+    def log_summary(self):
+        for line in self.summary():
+            self.log.info("%s", line)
+
+
 # master write helper objects
 class WriteCmd(NamedTuple):
     address: int
@@ -125,7 +386,7 @@ class PsdpRamBus:
         return cls(write, read)
 
 
-class PsdpRamMasterWrite(Region):
+class PsdpRamMasterWrite(PauseMixin, Region):
 
     def __init__(self, bus, clock, reset=None, **kwargs):
         self.bus = bus
@@ -139,9 +400,8 @@ class PsdpRamMasterWrite(Region):
         self.log.info("Parallel Simple Dual Port RAM master model (write)")
         self.log.info("Copyright (c) 2020 Alex Forencich")
 
-        self.pause = False
-        self._pause_generator = None
-        self._pause_cr = None
+        self.monitor = None
+        self._init_pause()
 
         self.in_flight_operations = 0
         self._idle = Event()
@@ -167,8 +427,9 @@ class PsdpRamMasterWrite(Region):
         self.write_command_queue.queue_occupancy_limit = 2
         self.current_write_command = None
 
-        self.seg_write_queue = [Queue() for x in range(self.seg_count)]
-        self.seg_write_resp_queue = [Queue() for x in range(self.seg_count)]
+        self.seg_write_queue = [deque() for x in range(self.seg_count)]
+        self.seg_write_resp_queue = [deque() for x in range(self.seg_count)]
+        self.seg_write_resp_event = Event()
 
         self.int_write_resp_command_queue = Queue()
         self.current_write_resp_command = None
@@ -190,18 +451,13 @@ class PsdpRamMasterWrite(Region):
         cocotb.start_soon(self._process_write_resp())
         cocotb.start_soon(self._run())
 
-    def set_pause_generator(self, generator=None):
-        if self._pause_cr is not None:
-            self._pause_cr.kill()
-            self._pause_cr = None
-
-        self._pause_generator = generator
+    def enable_monitor(self):
+        if self.monitor is None:
+            self.monitor = PsdpRamMonitor("write", self.seg_count, self.seg_byte_lanes, self.log)
+        return self.monitor
 
-        if self._pause_generator is not None:
-            self._pause_cr = cocotb.start_soon(self._run_pause())
-
-    def clear_pause_generator(self):
-        self.set_pause_generator(None)
+    def disable_monitor(self):
+        self.monitor = None
 
     def idle(self):
         return not self.in_flight_operations
@@ -266,17 +522,14 @@ class PsdpRamMasterWrite(Region):
                     stop = seg_end_offset
                     be &= seg_be_end
 
-                val = 0
-                for j in range(start, stop):
-                    val |= cmd.data[offset] << j*8
-                    offset += 1
-
                 op = SegWriteData()
                 op.addr = (cmd.address + k*self.seg_byte_lanes) // self.byte_lanes
-                op.data = val
+                op.data = int.from_bytes(cmd.data[offset:offset+stop-start], 'little') << start*8
                 op.be = be
 
-                await self.seg_write_queue[seg].put(op)
+                offset += stop-start
+
+                self.seg_write_queue[seg].append(op)
 
                 seg = (seg + 1) % self.seg_count
 
@@ -289,7 +542,10 @@ class PsdpRamMasterWrite(Region):
 
             seg = cmd.first_seg
             for k in range(cmd.segments):
-                await self.seg_write_resp_queue[seg].get()
+                while not self.seg_write_resp_queue[seg]:
+                    self.seg_write_resp_event.clear()
+                    await self.seg_write_resp_event.wait()
+                self.seg_write_resp_queue[seg].popleft()
 
                 seg = (seg + 1) % self.seg_count
 
@@ -318,6 +574,8 @@ class PsdpRamMasterWrite(Region):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             cmd_ready_sample = int(self.bus.wr_cmd_ready.value)
             done_sample = int(self.bus.wr_done.value)
 
@@ -325,13 +583,16 @@ class PsdpRamMasterWrite(Region):
                 self.bus.wr_cmd_valid.value = 0
                 continue
 
+            if self.monitor is not None:
+                self.monitor.sample(cmd_valid, cmd_ready_sample, done_sample, cmd_be)
+
             # process segments
             for seg in range(self.seg_count):
                 seg_mask = 1 << seg
 
                 if (cmd_ready_sample & seg_mask) or not (cmd_valid & seg_mask):
-                    if not self.seg_write_queue[seg].empty() and not self.pause:
-                        op = await self.seg_write_queue[seg].get()
+                    if self.seg_write_queue[seg] and not self.pause:
+                        op = self.seg_write_queue[seg].popleft()
                         cmd_addr &= ~(self.seg_addr_mask << self.seg_addr_width*seg)
                         cmd_addr |= ((op.addr & self.seg_addr_mask) << self.seg_addr_width*seg)
                         cmd_data &= ~(self.seg_data_mask << self.seg_data_width*seg)
@@ -347,22 +608,16 @@ class PsdpRamMasterWrite(Region):
                         cmd_valid &= ~seg_mask
 
                 if done_sample & seg_mask:
-                    await self.seg_write_resp_queue[seg].put(None)
+                    self.seg_write_resp_queue[seg].append(None)
+                    self.seg_write_resp_event.set()
 
             self.bus.wr_cmd_valid.value = cmd_valid
             self.bus.wr_cmd_addr.value = cmd_addr
             self.bus.wr_cmd_data.value = cmd_data
             self.bus.wr_cmd_be.value = cmd_be
 
-    async def _run_pause(self):
-        clock_edge_event = RisingEdge(self.clock)
-
-        for val in self._pause_generator:
-            self.pause = val
-            await clock_edge_event
 
-
-class PsdpRamMasterRead(Region):
+class PsdpRamMasterRead(PauseMixin, Region):
 
     def __init__(self, bus, clock, reset=None, **kwargs):
         self.bus = bus
@@ -376,9 +631,8 @@ class PsdpRamMasterRead(Region):
         self.log.info("Parallel Simple Dual Port RAM master model (read)")
         self.log.info("Copyright (c) 2020 Alex Forencich")
 
-        self.pause = False
-        self._pause_generator = None
-        self._pause_cr = None
+        self.monitor = None
+        self._init_pause()
 
         self.in_flight_operations = 0
         self._idle = Event()
@@ -402,8 +656,9 @@ class PsdpRamMasterRead(Region):
         self.read_command_queue.queue_occupancy_limit = 2
         self.current_read_command = None
 
-        self.seg_read_queue = [Queue() for x in range(self.seg_count)]
-        self.seg_read_resp_queue = [Queue() for x in range(self.seg_count)]
+        self.seg_read_queue = [deque() for x in range(self.seg_count)]
+        self.seg_read_resp_queue = [deque() for x in range(self.seg_count)]
+        self.seg_read_resp_event = Event()
 
         self.int_read_resp_command_queue = Queue()
         self.current_read_resp_command = None
@@ -424,18 +679,13 @@ class PsdpRamMasterRead(Region):
         cocotb.start_soon(self._process_read_resp())
         cocotb.start_soon(self._run())
 
-    def set_pause_generator(self, generator=None):
-        if self._pause_cr is not None:
-            self._pause_cr.kill()
-            self._pause_cr = None
-
-        self._pause_generator = generator
-
-        if self._pause_generator is not None:
-            self._pause_cr = cocotb.start_soon(self._run_pause())
+    def enable_monitor(self):
+        if self.monitor is None:
+            self.monitor = PsdpRamMonitor("read", self.seg_count, self.seg_byte_lanes, self.log)
+        return self.monitor
 
-    def clear_pause_generator(self):
-        self.set_pause_generator(None)
+    def disable_monitor(self):
+        self.monitor = None
 
     def idle(self):
         return not self.in_flight_operations
@@ -483,7 +733,7 @@ class PsdpRamMasterRead(Region):
                 op = SegReadCmd()
                 op.addr = (cmd.address + k*self.seg_byte_lanes) // self.byte_lanes
 
-                await self.seg_read_queue[seg].put(op)
+                self.seg_read_queue[seg].append(op)
 
                 seg = (seg + 1) % self.seg_count
 
@@ -501,7 +751,10 @@ class PsdpRamMasterRead(Region):
 
             seg = cmd.first_seg
             for k in range(cmd.segments):
-                seg_data = await self.seg_read_resp_queue[seg].get()
+                while not self.seg_read_resp_queue[seg]:
+                    self.seg_read_resp_event.clear()
+                    await self.seg_read_resp_event.wait()
+                seg_data = self.seg_read_resp_queue[seg].popleft()
 
                 start = 0
                 stop = self.seg_byte_lanes
@@ -511,8 +764,7 @@ class PsdpRamMasterRead(Region):
                 if k == cmd.segments-1:
                     stop = seg_end_offset
 
-                for j in range(start, stop):
-                    data.extend(bytearray([(seg_data >> j*8) & 0xff]))
+                data.extend(seg_data.to_bytes(self.seg_byte_lanes, 'little')[start:stop])
 
                 seg = (seg + 1) % self.seg_count
 
@@ -541,6 +793,8 @@ class PsdpRamMasterRead(Region):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             cmd_ready_sample = int(self.bus.rd_cmd_ready.value)
             resp_valid_sample = int(self.bus.rd_resp_valid.value)
 
@@ -554,13 +808,16 @@ class PsdpRamMasterRead(Region):
                 resp_ready = 0
                 continue
 
+            if self.monitor is not None:
+                self.monitor.sample(cmd_valid, cmd_ready_sample, resp_ready & resp_valid_sample)
+
             # process segments
             for seg in range(self.seg_count):
                 seg_mask = 1 << seg
 
                 if (cmd_ready_sample & seg_mask) or not (cmd_valid & seg_mask):
-                    if not self.seg_read_queue[seg].empty() and not self.pause:
-                        op = await self.seg_read_queue[seg].get()
+                    if self.seg_read_queue[seg] and not self.pause:
+                        op = self.seg_read_queue[seg].popleft()
                         cmd_addr &= ~(self.seg_addr_mask << self.seg_addr_width*seg)
                         cmd_addr |= ((op.addr & self.seg_addr_mask) << self.seg_addr_width*seg)
                         cmd_valid |= seg_mask
@@ -573,7 +830,8 @@ class PsdpRamMasterRead(Region):
                 if resp_ready & resp_valid_sample & (1 << seg):
                     seg_data = (resp_data_sample >> self.seg_data_width*seg) & self.seg_data_mask
 
-                    await self.seg_read_resp_queue[seg].put(seg_data)
+                    self.seg_read_resp_queue[seg].append(seg_data)
+                    self.seg_read_resp_event.set()
 
             resp_ready = 2**self.seg_count-1
 
@@ -585,13 +843,6 @@ class PsdpRamMasterRead(Region):
 
             self.bus.rd_resp_ready.value = resp_ready
 
-    async def _run_pause(self):
-        clock_edge_event = RisingEdge(self.clock)
-
-        for val in self._pause_generator:
-            self.pause = val
-            await clock_edge_event
-
 
 class PsdpRamMaster(Region):
     def __init__(self, bus, clock, reset=None, **kwargs):
@@ -623,6 +874,13 @@ class PsdpRamMaster(Region):
     async def wait_write(self):
         await self.write_if.wait()
 
+    def enable_monitor(self):
+        return self.write_if.enable_monitor(), self.read_if.enable_monitor()
+
+    def disable_monitor(self):
+        self.write_if.disable_monitor()
+        self.read_if.disable_monitor()
+
     async def read(self, address, length):
         return await self.read_if.read(address, length)
 
@@ -630,7 +888,7 @@ class PsdpRamMaster(Region):
         return await self.write_if.write(address, data)
 
 
-class PsdpRamWrite(Memory):
+class PsdpRamWrite(PauseMixin, Memory):
 
     def __init__(self, bus, clock, reset=None, size=1024, mem=None, *args, **kwargs):
         self.bus = bus
@@ -641,11 +899,17 @@ class PsdpRamWrite(Memory):
         self.log.info("Parallel Simple Dual Port RAM model (write)")
         self.log.info("Copyright (c) 2020 Alex Forencich")
 
+        if size is None:
+            # cover the full segment address space
+            size = 2**(len(self.bus.wr_cmd_addr) // len(self.bus.wr_cmd_valid)) * len(self.bus.wr_cmd_be)
+
+        if mem is None:
+            mem = PagedMemory(size)
+
         super().__init__(size, mem, *args, **kwargs)
 
-        self.pause = False
-        self._pause_generator = None
-        self._pause_cr = None
+        self.monitor = None
+        self._init_pause()
 
         self.width = len(self.bus.wr_cmd_data)
         self.byte_size = 8
@@ -675,18 +939,13 @@ class PsdpRamWrite(Memory):
 
         cocotb.start_soon(self._run())
 
-    def set_pause_generator(self, generator=None):
-        if self._pause_cr is not None:
-            self._pause_cr.kill()
-            self._pause_cr = None
-
-        self._pause_generator = generator
-
-        if self._pause_generator is not None:
-            self._pause_cr = cocotb.start_soon(self._run_pause())
+    def enable_monitor(self):
+        if self.monitor is None:
+            self.monitor = PsdpRamMonitor("write", self.seg_count, self.seg_byte_lanes, self.log)
+        return self.monitor
 
-    def clear_pause_generator(self):
-        self.set_pause_generator(None)
+    def disable_monitor(self):
+        self.monitor = None
 
     async def _run(self):
         cmd_ready = 0
@@ -696,6 +955,8 @@ class PsdpRamWrite(Memory):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             wr_done = 0
 
             cmd_valid_sample = int(self.bus.wr_cmd_valid.value)
@@ -719,35 +980,23 @@ class PsdpRamWrite(Memory):
 
                     addr = (seg_addr*self.seg_count+seg)*self.seg_byte_lanes
 
-                    # generate operation list
-                    offset = 0
-                    start_offset = None
-                    write_ops = []
-
                     data = seg_data.to_bytes(self.seg_byte_lanes, 'little')
 
-                    for i in range(self.byte_lanes):
-                        if seg_be & (1 << i):
-                            if start_offset is None:
-                                start_offset = offset
-                        else:
-                            if start_offset is not None and offset != start_offset:
-                                write_ops.append((addr+start_offset, data[start_offset:offset]))
-                            start_offset = None
-
-                        offset += 1
-
-                    if start_offset is not None and offset != start_offset:
-                        write_ops.append((addr+start_offset, data[start_offset:offset]))
-
                     # perform writes
-                    for addr, data in write_ops:
+                    if seg_be == self.seg_be_mask:
                         self.write(addr, data)
+                    else:
+                        for start, stop in be_runs(seg_be):
+                            self.write(addr+start, data[start:stop])
 
                     wr_done |= 1 << seg
 
-                    self.log.info("Write word seg: %d addr: 0x%08x be 0x%02x data %s",
-                        seg, addr, seg_be, ' '.join((f'{c:02x}' for c in data)))
+                    if self.log.isEnabledFor(logging.INFO):
+                        self.log.info("Write word seg: %d addr: 0x%08x be 0x%02x data %s",
+                            seg, addr, seg_be, ' '.join((f'{c:02x}' for c in data)))
+
+            if self.monitor is not None:
+                self.monitor.sample(cmd_valid_sample, cmd_ready, wr_done, cmd_be_sample if cmd_valid_sample else 0)
 
             cmd_ready = 2**self.seg_count-1
 
@@ -757,15 +1006,8 @@ class PsdpRamWrite(Memory):
             self.bus.wr_cmd_ready.value = cmd_ready
             self.bus.wr_done.value = wr_done
 
-    async def _run_pause(self):
-        clock_edge_event = RisingEdge(self.clock)
-
-        for val in self._pause_generator:
-            self.pause = val
-            await clock_edge_event
 
-
-class PsdpRamRead(Memory):
+class PsdpRamRead(PauseMixin, Memory):
 
     def __init__(self, bus, clock, reset=None, size=1024, mem=None, *args, **kwargs):
         self.bus = bus
@@ -776,11 +1018,17 @@ class PsdpRamRead(Memory):
         self.log.info("Parallel Simple Dual Port RAM model (read)")
         self.log.info("Copyright (c) 2020 Alex Forencich")
 
+        if size is None:
+            # cover the full segment address space
+            size = 2**(len(self.bus.rd_cmd_addr) // len(self.bus.rd_cmd_valid)) * (len(self.bus.rd_resp_data) // 8)
+
+        if mem is None:
+            mem = PagedMemory(size)
+
         super().__init__(size, mem, *args, **kwargs)
 
-        self.pause = False
-        self._pause_generator = None
-        self._pause_cr = None
+        self.monitor = None
+        self._init_pause()
 
         self.width = len(self.bus.rd_resp_data)
         self.byte_size = 8
@@ -806,18 +1054,13 @@ class PsdpRamRead(Memory):
 
         cocotb.start_soon(self._run())
 
-    def set_pause_generator(self, generator=None):
-        if self._pause_cr is not None:
-            self._pause_cr.kill()
-            self._pause_cr = None
+    def enable_monitor(self):
+        if self.monitor is None:
+            self.monitor = PsdpRamMonitor("read", self.seg_count, self.seg_byte_lanes, self.log)
+        return self.monitor
 
-        self._pause_generator = generator
-
-        if self._pause_generator is not None:
-            self._pause_cr = cocotb.start_soon(self._run_pause())
-
-    def clear_pause_generator(self):
-        self.set_pause_generator(None)
+    def disable_monitor(self):
+        self.monitor = None
 
     async def _run(self):
         pipeline = [[None for x in range(1)] for seg in range(self.seg_count)]
@@ -831,6 +1074,8 @@ class PsdpRamRead(Memory):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             cmd_valid_sample = int(self.bus.rd_cmd_valid.value)
 
             if cmd_valid_sample:
@@ -845,6 +1090,9 @@ class PsdpRamRead(Memory):
                 resp_valid = 0
                 continue
 
+            if self.monitor is not None:
+                self.monitor.sample(cmd_valid_sample, cmd_ready, resp_valid & resp_ready_sample)
+
             # process segments
             for seg in range(self.seg_count):
                 seg_mask = 1 << seg
@@ -871,8 +1119,9 @@ class PsdpRamRead(Memory):
                     data = self.read(addr % self.size, self.seg_byte_lanes)
                     pipeline[seg][0] = int.from_bytes(data, 'little')
 
-                    self.log.info("Read word seg: %d addr: 0x%08x data %s",
-                        seg, addr, ' '.join((f'{c:02x}' for c in data)))
+                    if self.log.isEnabledFor(logging.INFO):
+                        self.log.info("Read word seg: %d addr: 0x%08x data %s",
+                            seg, addr, ' '.join((f'{c:02x}' for c in data)))
 
                 if (not resp_valid & seg_mask) or None in pipeline[seg]:
                     cmd_ready |= seg_mask
@@ -887,20 +1136,27 @@ class PsdpRamRead(Memory):
             self.bus.rd_resp_data.value = resp_data
             self.bus.rd_resp_valid.value = resp_valid
 
-    async def _run_pause(self):
-        clock_edge_event = RisingEdge(self.clock)
-
-        for val in self._pause_generator:
-            self.pause = val
-            await clock_edge_event
-
 
 class PsdpRam(Memory):
     def __init__(self, bus, clock, reset=None, size=1024, mem=None, *args, **kwargs):
         self.write_if = None
         self.read_if = None
 
+        if size is None:
+            # cover the full segment address space
+            size = 2**(len(bus.read.rd_cmd_addr) // len(bus.read.rd_cmd_valid)) * (len(bus.read.rd_resp_data) // 8)
+
+        if mem is None:
+            mem = PagedMemory(size)
+
         super().__init__(size, mem, *args, **kwargs)
 
         self.write_if = PsdpRamWrite(bus.write, clock, reset, mem=self.mem)
         self.read_if = PsdpRamRead(bus.read, clock, reset, mem=self.mem)
+
+    def enable_monitor(self):
+        return self.write_if.enable_monitor(), self.read_if.enable_monitor()
+
+    def disable_monitor(self):
+        self.write_if.disable_monitor()
+        self.read_if.disable_monitor()
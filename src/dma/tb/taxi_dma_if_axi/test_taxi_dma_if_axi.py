@@ -72,14 +72,14 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.axi_ram.write_if.b_channel.set_pause_generator(generator())
-            self.axi_ram.read_if.r_channel.set_pause_generator(generator())
+            self.axi_ram.write_if.b_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axi_ram.read_if.r_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.axi_ram.write_if.aw_channel.set_pause_generator(generator())
-            self.axi_ram.write_if.w_channel.set_pause_generator(generator())
-            self.axi_ram.read_if.ar_channel.set_pause_generator(generator())
+            self.axi_ram.write_if.aw_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axi_ram.write_if.w_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axi_ram.read_if.ar_channel.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.write_if.set_pause_generator(generator())
             self.dma_ram.read_if.set_pause_generator(generator())
 
@@ -96,7 +96,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
@@ -68,11 +68,11 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.axi_ram.r_channel.set_pause_generator(generator())
+            self.axi_ram.r_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.axi_ram.ar_channel.set_pause_generator(generator())
+            self.axi_ram.ar_channel.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.set_pause_generator(generator())
 
     async def cycle_reset(self):
@@ -88,7 +88,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
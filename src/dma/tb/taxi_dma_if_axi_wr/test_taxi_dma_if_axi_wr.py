@@ -68,12 +68,12 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.axi_ram.b_channel.set_pause_generator(generator())
+            self.axi_ram.b_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.axi_ram.aw_channel.set_pause_generator(generator())
-            self.axi_ram.w_channel.set_pause_generator(generator())
+            self.axi_ram.aw_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axi_ram.w_channel.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.set_pause_generator(generator())
 
     async def cycle_reset(self):
@@ -89,7 +89,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
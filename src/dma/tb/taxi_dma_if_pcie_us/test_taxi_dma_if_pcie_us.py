@@ -137,6 +137,7 @@ class TB(object):
 
         # DMA RAM
         self.dma_ram = PsdpRam(PsdpRamBus.from_entity(dut.dma_ram), dut.clk, dut.rst, size=2**16)
+        self.dma_ram.enable_monitor()
 
         # Control
         self.read_desc_source = DescSource(DescBus.from_entity(dut.rd_desc), dut.clk, dut.rst)
@@ -161,11 +162,11 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.dev.rc_source.set_pause_generator(generator())
+            self.dev.rc_source.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.dev.rq_sink.set_pause_generator(generator())
+            self.dev.rq_sink.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.write_if.set_pause_generator(generator())
             self.dma_ram.read_if.set_pause_generator(generator())
 
@@ -183,7 +184,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
@@ -249,6 +250,9 @@ async def run_test_write(dut, idle_inserter=None, backpressure_inserter=None):
 
                 cur_tag = (cur_tag + 1) % tag_count
 
+    tb.dma_ram.write_if.monitor.log_summary()
+    tb.dma_ram.read_if.monitor.log_summary()
+
     await RisingEdge(dut.clk)
     await RisingEdge(dut.clk)
 
@@ -314,6 +318,9 @@ async def run_test_read(dut, idle_inserter=None, backpressure_inserter=None):
 
                 cur_tag = (cur_tag + 1) % tag_count
 
+    tb.dma_ram.write_if.monitor.log_summary()
+    tb.dma_ram.read_if.monitor.log_summary()
+
     await RisingEdge(dut.clk)
     await RisingEdge(dut.clk)
 
@@ -154,11 +154,11 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.dev.rc_source.set_pause_generator(generator())
+            self.dev.rc_source.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.dev.rq_sink.set_pause_generator(generator())
+            self.dev.rq_sink.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.set_pause_generator(generator())
 
     async def _run_monitor_stat_err_cor(self):
@@ -175,7 +175,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
@@ -157,12 +157,12 @@ class TB(object):
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.dev.rq_sink.set_pause_generator(generator())
+            self.dev.rq_sink.set_pause_generator(itertools.cycle(generator()))
             self.dma_ram.set_pause_generator(generator())
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
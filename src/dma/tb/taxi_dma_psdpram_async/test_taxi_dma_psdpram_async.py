@@ -9,7 +9,6 @@ Authors:
 
 """
 
-import itertools
 import logging
 import os
 import random
@@ -72,7 +71,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
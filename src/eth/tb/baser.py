@@ -10,11 +10,19 @@ Authors:
 """
 
 import logging
+import math
+import mmap
+import os
+import random
+import struct
+from array import array
+from collections import deque
+from itertools import cycle
 
 import cocotb
 from cocotb.queue import Queue, QueueFull
 from cocotb.triggers import RisingEdge, Timer, First, Event
-from cocotb.utils import get_sim_time
+from cocotb.utils import get_sim_time, get_time_from_sim_steps
 
 from cocotbext.eth.constants import (EthPre, XgmiiCtrl, BaseRCtrl, BaseRO,
     BaseRSync, BaseRBlockType, xgmii_ctrl_to_baser_mapping,
@@ -22,10 +30,306 @@ from cocotbext.eth.constants import (EthPre, XgmiiCtrl, BaseRCtrl, BaseRO,
 from cocotbext.eth import XgmiiFrame
 
 
+# transmit frame events
+_TX_EVT_START = 0
+_TX_EVT_SFD = 1
+_TX_EVT_END = 2
+
+
+def scramble_64b66b(data, last):
+    # 64b/66b scrambler, G(x) = 1 + x^39 + x^58
+    # word-parallel; last is the previous scrambled block
+    # bits 0-38 only depend on the previous block
+    b = (data ^ (last >> 25) ^ (last >> 6)) & 0x7fffffffff
+    # bits 39-63 depend on bits 0-24 of the current block
+    x = last | b << 64
+    return (data ^ (x >> 25) ^ (x >> 6)) & 0xffffffffffffffff
+
+
+def descramble_64b66b(data, last):
+    # 64b/66b descrambler, G(x) = 1 + x^39 + x^58
+    # word-parallel; last is the previous scrambled block
+    x = last | data << 64
+    return (data ^ (x >> 25) ^ (x >> 6)) & 0xffffffffffffffff
+
+
+def _serial_scrambler_state(last):
+    # shift register state after shifting in the previous block
+    return sum(1 << i for i in range(58) if (last >> (63-i)) & 1)
+
+
+def scramble_64b66b_serial(data, last):
+    # 64b/66b scrambler, bit-serial reference implementation
+    scrambler_state = _serial_scrambler_state(last)
+    b = 0
+    for i in range(64):
+        if bool(scrambler_state & (1 << 38)) ^ bool(scrambler_state & (1 << 57)) ^ bool(data & (1 << i)):
+            scrambler_state = ((scrambler_state & 0x1ffffffffffffff) << 1) | 1
+            b = b | (1 << i)
+        else:
+            scrambler_state = (scrambler_state & 0x1ffffffffffffff) << 1
+    return b
+
+
+def descramble_64b66b_serial(data, last):
+    # 64b/66b descrambler, bit-serial reference implementation
+    scrambler_state = _serial_scrambler_state(last)
+    b = 0
+    for i in range(64):
+        if bool(scrambler_state & (1 << 38)) ^ bool(scrambler_state & (1 << 57)) ^ bool(data & (1 << i)):
+            b = b | (1 << i)
+        scrambler_state = (scrambler_state & 0x1ffffffffffffff) << 1 | bool(data & (1 << i))
+    return b
+
+
+# per-byte XGMII control character to BASE-R control code mapping, and reverse
+_xgmii_to_baser_ctrl = bytes(xgmii_ctrl_to_baser_mapping.get(k, BaseRCtrl.ERROR) for k in range(256))
+_baser_to_xgmii_ctrl = bytes(baser_ctrl_to_xgmii_mapping.get(k & 0x7f, XgmiiCtrl.ERROR) for k in range(256))
+
+# O code to XGMII ordered set control character
+_baser_o_to_xgmii = {BaseRO.SEQ_OS: XgmiiCtrl.SEQ_OS, BaseRO.SIG_OS: XgmiiCtrl.SIG_OS}
+
+# XGMII control character classes used to select the block type
+_XGMII_CLS_OTHER = 0
+_XGMII_CLS_START = 1
+_XGMII_CLS_SEQ_OS = 2
+_XGMII_CLS_SIG_OS = 3
+
+_xgmii_ctrl_cls = [_XGMII_CLS_OTHER]*256
+_xgmii_ctrl_cls[XgmiiCtrl.START] = _XGMII_CLS_START
+_xgmii_ctrl_cls[XgmiiCtrl.SEQ_OS] = _XGMII_CLS_SEQ_OS
+_xgmii_ctrl_cls[XgmiiCtrl.SIG_OS] = _XGMII_CLS_SIG_OS
+
+# bit offset of first control lane for each control lane bitmap
+_xgmii_first_ctrl_lane = [((c & -c).bit_length()-1)*8 for c in range(256)]
+
+_baser_term_block_type = {v: k for k, v in block_type_term_lane_mapping.items()}
+
+
+def _pack_baser_ctrl(d):
+    # 8 XGMII lanes to 8 7-bit BASE-R control codes
+    x = int.from_bytes(d.to_bytes(8, 'little').translate(_xgmii_to_baser_ctrl), 'little')
+    x = (x & 0x007f007f007f007f) | (x & 0x7f007f007f007f00) >> 1
+    x = (x & 0x00003fff00003fff) | (x & 0x3fff00003fff0000) >> 2
+    return (x & 0x000000000fffffff) | (x & 0x0fffffff00000000) >> 4
+
+
+def _unpack_baser_ctrl(x):
+    # 8 7-bit BASE-R control codes to 8 XGMII lanes
+    x = (x & 0x000000000fffffff) | (x & 0x00fffffff0000000) << 4
+    x = (x & 0x00003fff00003fff) | (x & 0x0fffc0000fffc000) << 2
+    x = (x & 0x007f007f007f007f) | (x & 0x3f803f803f803f80) << 1
+    return int.from_bytes(x.to_bytes(8, 'little').translate(_baser_to_xgmii_ctrl), 'little')
+
+
+def _baser_enc_entry(c, cls0, cls4, term):
+    # block encoding for control lane bitmap c, lane 0 and lane 4 character
+    # classes, and whether the first control lane holds /T/
+    # returns (base, data mask, data shift, ctrl mask)
+    if not c:
+        # data block, not encoded via table
+        return None
+
+    s0 = c & 0x01 and cls0 == _XGMII_CLS_START
+    s4 = c & 0x10 and cls4 == _XGMII_CLS_START
+    o0 = c & 0x01 and cls0 in {_XGMII_CLS_SEQ_OS, _XGMII_CLS_SIG_OS}
+    o4 = c & 0x10 and cls4 in {_XGMII_CLS_SEQ_OS, _XGMII_CLS_SIG_OS}
+    o0_sig = BaseRO.SIG_OS << 32 if cls0 == _XGMII_CLS_SIG_OS else 0
+    o4_sig = BaseRO.SIG_OS << 36 if cls4 == _XGMII_CLS_SIG_OS else 0
+
+    if s0 and c == 0x01:
+        # start in lane 0
+        return (BaseRBlockType.START_0, 0xffffffffffffff00, 0, 0)
+    elif s4 and c & 0xf0 == 0x10:
+        # start in lane 4
+        if o0 and c & 0x0f == 0x01:
+            # ordered set in lane 0
+            return (BaseRBlockType.OS_START | o0_sig, 0xffffff00ffffff00, 0, 0)
+        else:
+            # other control
+            return (BaseRBlockType.START_4, 0xffffff0000000000, 0, 0x000000000fffffff)
+    elif o0 and c & 0x0f == 0x01:
+        # ordered set in lane 0
+        if o4 and c & 0xf0 == 0x10:
+            # ordered set in lane 4
+            return (BaseRBlockType.OS_04 | o0_sig | o4_sig, 0xffffff00ffffff00, 0, 0)
+        else:
+            return (BaseRBlockType.OS_0 | o0_sig, 0x00000000ffffff00, 0, 0x00fffffff0000000)
+    elif o4 and c & 0xf0 == 0x10:
+        # ordered set in lane 4
+        return (BaseRBlockType.OS_4 | o4_sig, 0xffffff0000000000, 0, 0x000000000fffffff)
+    elif term:
+        # terminate in first control lane
+        lane = _xgmii_first_ctrl_lane[c] // 8
+        return (_baser_term_block_type[lane], ((1 << lane*8)-1) << 8, 8, 0x00ffffffffffffff & ~((1 << (lane+1)*7)-1))
+    else:
+        # all control
+        return (BaseRBlockType.CTRL, 0, 0, 0x00ffffffffffffff)
+
+
+# block encoder dispatch table, indexed by control lane bitmap, lane 0 and
+# lane 4 character classes, and /T/ in first control lane
+_baser_enc_table = [_baser_enc_entry(k & 0xff, (k >> 8) & 3, (k >> 10) & 3, (k >> 12) & 1) for k in range(1 << 13)]
+
+
+def xgmii_to_baser(d, c):
+    # encode one 8-lane XGMII word (data, control lane bitmap) into a 66b block
+    # returns (sync header, block payload)
+    if not c:
+        return BaseRSync.DATA, d
+
+    key = (c | _xgmii_ctrl_cls[d & 0xff] << 8 | _xgmii_ctrl_cls[(d >> 32) & 0xff] << 10
+        | (((d >> _xgmii_first_ctrl_lane[c]) & 0xff) == XgmiiCtrl.TERM) << 12)
+    base, dmask, dshift, cmask = _baser_enc_table[key]
+
+    data = base | (d << dshift) & dmask
+    if cmask:
+        data |= (_pack_baser_ctrl(d) & cmask) << 8
+    return BaseRSync.CTRL, data
+
+
+def _baser_dec_entry(bt):
+    # block decoding for block type bt
+    # returns (control lane bitmap, data mask, data shift, ctrl mask, const lanes, O code lanes)
+    if bt == BaseRBlockType.CTRL:
+        # C7 C6 C5 C4 C3 C2 C1 C0 BT
+        return (0xff, 0, 0, 0xffffffffffffffff, 0, 0)
+    elif bt == BaseRBlockType.OS_4:
+        # D7 D6 D5 O4 C3 C2 C1 C0 BT
+        return (0x1f, 0xffffff0000000000, 0, 0x00000000ffffffff, 0, 0x10)
+    elif bt == BaseRBlockType.START_4:
+        # D7 D6 D5    C3 C2 C1 C0 BT
+        return (0x1f, 0xffffff0000000000, 0, 0x00000000ffffffff, XgmiiCtrl.START << 32, 0)
+    elif bt == BaseRBlockType.OS_START:
+        # D7 D6 D5    O0 D3 D2 D1 BT
+        return (0x11, 0xffffff00ffffff00, 0, 0, XgmiiCtrl.START << 32, 0x01)
+    elif bt == BaseRBlockType.OS_04:
+        # D7 D6 D5 O4 O0 D3 D2 D1 BT
+        return (0x11, 0xffffff00ffffff00, 0, 0, 0, 0x11)
+    elif bt == BaseRBlockType.START_0:
+        # D7 D6 D5 D4 D3 D2 D1    BT
+        return (0x01, 0xffffffffffffff00, 0, 0, XgmiiCtrl.START, 0)
+    elif bt == BaseRBlockType.OS_0:
+        # C7 C6 C5 C4 O0 D3 D2 D1 BT
+        return (0xf1, 0x00000000ffffff00, 0, 0xffffffff00000000, 0, 0x01)
+    elif bt in block_type_term_lane_mapping:
+        # C7 C6 C5 C4 C3 C2 C1    BT
+        # ...
+        #    D6 D5 D4 D3 D2 D1 D0 BT
+        lane = block_type_term_lane_mapping[bt]
+        return ((0xff << lane) & 0xff, (1 << lane*8)-1, 8,
+            0xffffffffffffffff & ~((1 << (lane+1)*8)-1), XgmiiCtrl.TERM << lane*8, 0)
+    else:
+        # invalid block type
+        return None
+
+
+# block decoder dispatch table, indexed by block type
+_baser_dec_table = [_baser_dec_entry(k) for k in range(256)]
+
+
+def baser_to_xgmii(hdr, data):
+    # decode one 66b block into an 8-lane XGMII word
+    # returns (data, control lane bitmap, ordered set lanes, error)
+    if hdr == BaseRSync.DATA:
+        return data, 0, 0, None
+    elif hdr != BaseRSync.CTRL:
+        return 0xfefefefefefefefe, 0xff, 0, "Invalid sync header"
+
+    blk = _baser_dec_table[data & 0xff]
+
+    if blk is None:
+        return 0xfefefefefefefefe, 0xff, 0, "Invalid block type"
+
+    c, dmask, dshift, cmask, const, os = blk
+
+    d = (data >> dshift) & dmask | const
+    if cmask:
+        d |= _unpack_baser_ctrl(data >> 8) & cmask
+
+    err = None
+    if os:
+        if os & 0x01:
+            o = _baser_o_to_xgmii.get((data >> 32) & 0xf)
+            if o is None:
+                err = "Invalid O code"
+                o = XgmiiCtrl.ERROR
+            d |= o
+        if os & 0x10:
+            o = _baser_o_to_xgmii.get((data >> 36) & 0xf)
+            if o is None:
+                err = "Invalid O code"
+                o = XgmiiCtrl.ERROR
+            d |= o << 32
+
+    return d, c, os, err
+
+
+def gbx_schedule(seq_len, seq_stall, in_bits, out_bits, rx=False):
+    # precompute cyclic gearbox schedule
+    # returns one (seq, stall, bit_cnt) entry per cycle, starting at
+    # sequence step 1; bit_cnt is the numerator of the gearbox delay
+    steps = list(range(seq_len))
+    bit_cnt = 0
+    sched = None
+
+    # one pass from step 0 primes the bit count, then repeat from step 1
+    # until the bit count settles into a periodic pattern
+    for n in range(16):
+        prev = sched
+        sched = []
+        for seq in steps:
+            stall = seq in seq_stall
+            if rx:
+                bit_cnt = max(bit_cnt - out_bits, 0)
+                if not stall:
+                    bit_cnt += in_bits
+            else:
+                bit_cnt += in_bits
+                if not stall:
+                    bit_cnt = max(bit_cnt - out_bits, 0)
+            sched.append((seq, stall, bit_cnt))
+        if sched == prev:
+            break
+        steps = list(range(1, seq_len)) + [0]
+
+    return sched
+
+
+class XgmiiViewFrame(XgmiiFrame):
+    # frame with data held as a memoryview into a receive arena
+
+    def get_preamble_len(self):
+        for k, d in enumerate(self.data):
+            if d == EthPre.SFD:
+                return k+1
+        raise ValueError("SFD not found")
+
+    def __eq__(self, other):
+        if not isinstance(other, XgmiiFrame):
+            return NotImplemented
+        if bytes(self.data) != bytes(other.data):
+            return False
+        # missing or all-zero ctrl are equivalent
+        ctrl = list(self.ctrl) if self.ctrl is not None and any(self.ctrl) else None
+        other_ctrl = list(other.ctrl) if other.ctrl is not None and any(other.ctrl) else None
+        return ctrl == other_ctrl
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}(data={bytes(self.data)!r}, "
+            f"ctrl={self.ctrl!r}, "
+            f"sim_time_start={self.sim_time_start!r}, "
+            f"sim_time_sfd={self.sim_time_sfd!r}, "
+            f"sim_time_end={self.sim_time_end!r}, "
+            f"start_lane={self.start_lane!r})"
+        )
+
+
 class BaseRSerdesSource():
 
     def __init__(self, data, hdr, clock, enable=None, slip=None, data_valid=None, hdr_valid=None,
-            gbx_sync=None, scramble=True, reverse=False, gbx_cfg=None, *args, **kwargs):
+            gbx_sync=None, scramble=True, reverse=False, gbx_cfg=None, bank=None, *args, **kwargs):
 
         self.log = logging.getLogger(f"cocotb.{data._path}")
         self.data = data
@@ -37,6 +341,7 @@ class BaseRSerdesSource():
         self.hdr_valid = hdr_valid
         self.gbx_sync = gbx_sync
         self.scramble = scramble
+        self.scramble_serial = False
         self.reverse = reverse
 
         self.log.info("BASE-R serdes source")
@@ -61,6 +366,8 @@ class BaseRSerdesSource():
         self.gbx_seq = 0
         self.gbx_seq_len = None
         self.gbx_seq_stall = None
+        self.gbx_sched = None
+        self.gbx_sched_iter = None
         self.gbx_in_bits = 66
         self.gbx_out_bits = 66
         self.gbx_bit_cnt = 0
@@ -76,6 +383,29 @@ class BaseRSerdesSource():
         self.os = None
         self.os_sig = False
 
+        self.clear_stats()
+
+        # error injection
+        self._err_sched = deque()
+        self._err_blk = 0
+        self._err_next = -1
+        self._err_rng = None
+        self._err_ber = 0
+        self._err_hdr = True
+        self._err_bit = 0
+
+        # ahead-of-time encoding
+        self.pre_encode = False
+        self._tx_state = (None, 0, False, False, False, False, 0, 0, 0)
+        self._tx_pre_frame = None
+        self._tx_pre_frames = deque()
+        self._tx_blocks = array('Q')
+        self._tx_hdrs = bytearray()
+        self._tx_rd = 0
+        self._tx_events = deque()
+        self._tx_gen_idx = 0
+        self._tx_word_idx = 0
+
         self.width = len(self.data)
         self.byte_size = 8
         self.byte_lanes = self.width // self.byte_size
@@ -105,7 +435,11 @@ class BaseRSerdesSource():
         if self.gbx_sync is not None:
             self.gbx_sync.setimmediatevalue(0)
 
-        self._run_cr = cocotb.start_soon(self._run())
+        if bank is not None:
+            self._run_cr = None
+            bank.add_lane(self)
+        else:
+            self._run_cr = cocotb.start_soon(self._run())
 
     def set_gbx_cfg(self, seq_len=None, seq_stall=None):
         self.log.info("Set gearbox configuration")
@@ -115,9 +449,15 @@ class BaseRSerdesSource():
             self.gbx_bit_cnt = 0
             self.gbx_seq_len = None
             self.gbx_seq_stall = None
+            self.gbx_sched = None
             self.gbx_in_bits = 66
             self.gbx_out_bits = 66
             self.gbx_seq = 0
+            return
+
+        if isinstance(seq_stall, int):
+            # stall count; stall cycles at the end of the sequence
+            seq_stall = range(seq_len-seq_stall, seq_len)
 
         seq_stall = sorted(list(set(seq_stall)))
 
@@ -143,20 +483,20 @@ class BaseRSerdesSource():
         self.gbx_seq_stall = set(seq_stall)
         self.gbx_in_bits = in_bits
         self.gbx_out_bits = out_bits
-        self.gbx_bit_cnt = 0
 
-        for k in range(self.gbx_seq_len):
-            self.gbx_bit_cnt += in_bits
-            if k in self.gbx_seq_stall:
-                continue
-            self.gbx_bit_cnt = max(self.gbx_bit_cnt - out_bits, 0)
+        self.gbx_sched = gbx_schedule(seq_len, self.gbx_seq_stall, in_bits, out_bits)
+        self.gbx_sched_iter = cycle(self.gbx_sched)
+        self.gbx_bit_cnt = self.gbx_sched[-1][2]
 
     async def send(self, frame):
         while self.full():
             self.dequeue_event.clear()
             await self.dequeue_event.wait()
         frame = XgmiiFrame(frame)
-        await self.queue.put(frame)
+        if self.pre_encode:
+            self._pre_encode_frame(frame)
+        else:
+            await self.queue.put(frame)
         self.idle_event.clear()
         self.queue_occupancy_bytes += len(frame)
         self.queue_occupancy_frames += 1
@@ -165,16 +505,63 @@ class BaseRSerdesSource():
         if self.full():
             raise QueueFull()
         frame = XgmiiFrame(frame)
-        self.queue.put_nowait(frame)
+        if self.pre_encode:
+            self._pre_encode_frame(frame)
+        else:
+            self.queue.put_nowait(frame)
         self.idle_event.clear()
         self.queue_occupancy_bytes += len(frame)
         self.queue_occupancy_frames += 1
 
+    async def feed(self, frames, rate=1.0, depth=2, tx_complete=None):
+        # send frames from an iterable (e.g. PcapReader.frames()), pulling
+        # them lazily; rate sets the fraction of line rate to use
+        if rate <= 0:
+            raise ValueError(f"Invalid rate {rate} (must be greater than 0)")
+
+        for frame in frames:
+            while self.count() >= depth:
+                self.dequeue_event.clear()
+                await self.dequeue_event.wait()
+
+            if tx_complete is not None:
+                frame.tx_complete = tx_complete
+
+            if rate >= 1.0:
+                await self.send(frame)
+                continue
+
+            # wait for the frame to go out, then idle in proportion
+            # to the time it occupied the link
+            done = Event()
+            sent = []
+
+            def tx_done(f):
+                sent.append(f)
+                done.set()
+
+            cb = frame.tx_complete
+            frame.tx_complete = tx_done
+            await self.send(frame)
+            await done.wait()
+            frame = sent[0]
+
+            frame.tx_complete = cb
+            frame.handle_tx_complete()
+
+            if frame.sim_time_end is None:
+                # dropped by clear()
+                continue
+
+            idle = int((frame.sim_time_end - frame.sim_time_start) * (1/rate - 1))
+            if idle > 0:
+                await Timer(idle, 'step')
+
     def count(self):
-        return self.queue.qsize()
+        return self.queue.qsize() + len(self._tx_pre_frames)
 
     def empty(self):
-        return self.queue.empty()
+        return self.queue.empty() and not self._tx_pre_frames
 
     def full(self):
         if self.queue_occupancy_limit_bytes > 0 and self.queue_occupancy_bytes > self.queue_occupancy_limit_bytes:
@@ -192,6 +579,23 @@ class BaseRSerdesSource():
             frame = self.queue.get_nowait()
             frame.sim_time_end = None
             frame.handle_tx_complete()
+        if self._tx_pre_frames:
+            # rewind encoder to the start of the first pre-encoded frame
+            # that has not started transmission yet
+            frame, state, word_idx = self._tx_pre_frames[0]
+            self._tx_state = state
+            self._tx_gen_idx = word_idx
+            del self._tx_blocks[self._tx_rd+max(word_idx-self._tx_word_idx, 0):]
+            del self._tx_hdrs[self._tx_rd+max(word_idx-self._tx_word_idx, 0):]
+            while self._tx_events and self._tx_events[-1][0] >= word_idx:
+                self._tx_events.pop()
+            # regenerate any words that were already sent
+            while self._tx_gen_idx < self._tx_word_idx:
+                self._gen_xgmii_word()
+            for frame, state, word_idx in self._tx_pre_frames:
+                frame.sim_time_end = None
+                frame.handle_tx_complete()
+            self._tx_pre_frames.clear()
         self.dequeue_event.set()
         self.idle_event.set()
         self.queue_occupancy_bytes = 0
@@ -218,33 +622,249 @@ class BaseRSerdesSource():
         self.os = os
         self.os_sig = sig
 
-    async def _run(self):
-        frame = None
-        frame_offset = 0
-        sof = False
-        in_pre = False
+    def set_error_schedule(self, schedule=None):
+        # inject errors from a list of (block, data mask, header mask),
+        # block is counted from the next block sent
+        sched = {}
+        for b, d, h in schedule or []:
+            d0, h0 = sched.get(b, (0, 0))
+            sched[b] = (d0 ^ d, h0 ^ h)
+        self._err_sched = deque((self._err_blk+b, d, h) for b, (d, h) in sorted(sched.items()))
+        self._err_rng = None
+        self._err_next = self._err_sched[0][0] if self._err_sched else -1
+
+    def set_ber(self, ber=None, seed=None, hdr_errors=True):
+        # inject random bit errors at the specified bit error rate; error
+        # positions are drawn in bulk from a seeded RNG
+        self._err_sched = deque()
+        self._err_next = -1
+        self._err_rng = None
+
+        if not ber:
+            return
+
+        self.log.info("Set bit error rate: %g (seed %s)", ber, seed)
+
+        self._err_rng = random.Random(seed)
+        self._err_ber = ber
+        self._err_hdr = hdr_errors
+        self._err_bit = self._err_blk * (66 if hdr_errors else 64)
+        self._gen_errors()
+
+    def _gen_errors(self, count=1024):
+        # extend error schedule with the next count bit errors
+        rng = self._err_rng
+        bits = 66 if self._err_hdr else 64
+        log_q = math.log1p(-self._err_ber) if self._err_ber < 1 else None
+        sched = self._err_sched
+        bit = self._err_bit
+
+        for k in range(count):
+            # geometric distribution of error-free bits
+            if log_q is not None:
+                bit += int(math.log(1.0 - rng.random()) / log_q)
+            blk, offset = divmod(bit, bits)
+            if not self._err_hdr:
+                offset += 2
+            if offset < 2:
+                d, h = 0, 1 << offset
+            else:
+                d, h = 1 << (offset-2), 0
+            if sched and sched[-1][0] == blk:
+                b, d0, h0 = sched.pop()
+                d, h = d ^ d0, h ^ h0
+            sched.append((blk, d, h))
+            bit += 1
+
+        self._err_bit = bit
+        self._err_next = sched[0][0]
+
+    def _inject_error(self, data, hdr):
+        if self._err_rng is not None and len(self._err_sched) < 2:
+            self._gen_errors()
+
+        blk, d, h = self._err_sched.popleft()
+        self.stat_err_blocks += 1
+
+        self._err_next = self._err_sched[0][0] if self._err_sched else -1
+
+        return data ^ d, hdr ^ h
+
+    def clear_stats(self):
+        self.stat_blocks = 0
+        self.stat_idle_blocks = 0
+        self.stat_err_blocks = 0
+        self.stat_frames = 0
+        self.stat_bytes = 0
+        self.stat_busy_time = 0
+        self.stat_slips = 0
+        self.stat_dic_hist = [0]*4
+        self.stat_time_start = get_sim_time()
+
+    def get_stats(self):
+        elapsed = get_sim_time() - self.stat_time_start
+        return {
+            'blocks': self.stat_blocks,
+            'idle_blocks': self.stat_idle_blocks,
+            'frames': self.stat_frames,
+            'bytes': self.stat_bytes,
+            'utilization': self.stat_busy_time / elapsed if elapsed > 0 else 0.0,
+            'slips': self.stat_slips,
+            'err_blocks': self.stat_err_blocks,
+            'dic_hist': list(self.stat_dic_hist),
+        }
+
+    def _pre_encode_frame(self, frame):
+        # run the encoder ahead of the clock until the frame has been
+        # terminated, storing the encoded 66b blocks
+        self._tx_pre_frames.append((frame, self._tx_state, self._tx_gen_idx))
+        self._tx_pre_frame = frame
+
+        while self._tx_pre_frame is not None or self._tx_state[0] is frame:
+            hdr, data = xgmii_to_baser(*self._gen_xgmii_word())
+            self._tx_blocks.append(data)
+            self._tx_hdrs.append(hdr)
+
+    def _get_tx_frame(self):
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        frame = self._tx_pre_frame
+        self._tx_pre_frame = None
+        return frame
+
+    def _gen_xgmii_word(self):
+        # generate one 8-lane XGMII word, returns (data, control lane bitmap)
+        frame, frame_offset, sof, in_pre, sfd_pending, in_term, ifg_cnt, deficit_idle_cnt, rep_cnt = self._tx_state
+
+        dl = bytearray()
+        cl = 0
+
+        for k in range(8):
+            if k % 4 != 0 or rep_cnt != 0 or (self.force_offset_start and k == 0) or in_term:
+                pass
+            elif ifg_cnt + deficit_idle_cnt > 4-1 or (not self.enable_dic and ifg_cnt > 0):
+                # in IFG
+                ifg_cnt = ifg_cnt - 4
+                if ifg_cnt < 0:
+                    if self.enable_dic:
+                        deficit_idle_cnt = max(deficit_idle_cnt+ifg_cnt, 0)
+                    ifg_cnt = 0
+            elif frame is None:
+                # idle
+                frame = self._get_tx_frame()
+                if frame is not None:
+                    # send frame
+                    frame.sim_time_start = None
+                    frame.sim_time_sfd = None
+                    frame.sim_time_end = None
+                    self.log.info("TX frame: %s", frame)
+                    frame.normalize()
+                    frame.start_lane = 0
+                    assert frame.data[0] == EthPre.PRE
+                    assert frame.ctrl[0] == 0
+
+                    if self.enable_dic:
+                        deficit_idle_cnt = max(deficit_idle_cnt+ifg_cnt, 0)
+                    ifg_cnt = 0
+                    self.stat_dic_hist[deficit_idle_cnt] += 1
+                    frame_offset = 0
+                    sof = True
+                    in_pre = True
+                    sfd_pending = True
+                else:
+                    # clear counters
+                    deficit_idle_cnt = 0
+                    ifg_cnt = 0
+                    self.active = False
+                    self.idle_event.set()
+
+            d = XgmiiCtrl.IDLE
+            c = 1
+            if frame is not None:
+                if sof:
+                    sof = False
+                    d = XgmiiCtrl.START
+                    c = 1
+                    frame.start_lane = k
+                    self._tx_events.append((self._tx_gen_idx, _TX_EVT_START, k, frame))
+                elif frame_offset >= len(frame.data):
+                    d = XgmiiCtrl.TERM
+                    c = 1
+                    in_term = True
+                    ifg_cnt = max(self.ifg - (8-k), 0)
+                    self._tx_events.append((self._tx_gen_idx, _TX_EVT_END, k, frame))
+                    frame = None
+                else:
+                    d = frame.data[frame_offset]
+                    c = frame.ctrl[frame_offset]
+                    if sfd_pending and not in_pre:
+                        sfd_pending = False
+                        self._tx_events.append((self._tx_gen_idx, _TX_EVT_SFD, k, frame))
+                    if d == EthPre.SFD and (not self.xgmii_rep_count or rep_cnt == 1):
+                        in_pre = False
+                    if frame_offset == 0:
+                        d = 0xAA
+                        c = 0
+
+            dl.append(d)
+            cl |= c << k
+
+            frame_offset += 1
+            if k % 4 == 3:
+                if rep_cnt > 0:
+                    rep_cnt -= 1
+                elif self.xgmii_rep_count:
+                    if self.xgmii_rep_count % 2 == 0 or (k != 3 if self.force_offset_start else k == 3):
+                        rep_cnt = self.xgmii_rep_count
+                if rep_cnt > 0:
+                    frame_offset -= 4
+
+        # replace idles with ordered sets
+        if self.os is not None:
+            for k in [0, 4]:
+                if (cl >> k) & 0xf == 0xf and all(d == XgmiiCtrl.IDLE for d in dl[k:k+4]):
+                    if self.os_sig:
+                        self.log.info("TX signal ordered set: 0x%06x", self.os)
+                        dl[k] = XgmiiCtrl.SIG_OS
+                    else:
+                        self.log.info("TX sequence ordered set: 0x%06x", self.os)
+                        dl[k] = XgmiiCtrl.SEQ_OS
+                    dl[k+1:k+4] = self.os.to_bytes(3, 'big')
+                    cl &= ~(0xe << k)
+
         in_term = False
-        ifg_cnt = 0
-        deficit_idle_cnt = 0
-        scrambler_state = 0
-        last_d = 0
-        self.active = False
+
+        self._tx_state = (frame, frame_offset, sof, in_pre, sfd_pending, in_term, ifg_cnt, deficit_idle_cnt, rep_cnt)
+        self._tx_gen_idx += 1
+
+        return int.from_bytes(dl, 'little'), cl
+
+    async def _run(self):
+        edge = self._edge()
+        edge.send(None)
 
         clock_edge_event = RisingEdge(self.clock)
 
+        while True:
+            await clock_edge_event
+            edge.send(get_sim_time())
+
+    def _edge(self):
+        # per-clock-edge processing, driven by _run or by a BaseRSerdesBank
+        last_d = 0
+        self.active = False
+
         clk_period = 0
         last_clk = 0
         gbx_delay = 0
 
+        scrambler_state = 0
         data = 0
         hdr = 0
 
-        rep_cnt = 0
-
         while True:
-            await clock_edge_event
+            sim_time = yield
 
-            sim_time = get_sim_time()
             if last_clk:
                 clk_period = sim_time - last_clk
             last_clk = sim_time
@@ -255,15 +875,13 @@ class BaseRSerdesSource():
 
             # gearbox sequence
             if self.gbx_seq_len:
-                self.gbx_seq = (self.gbx_seq + 1) % self.gbx_seq_len
+                self.gbx_seq, stall, self.gbx_bit_cnt = next(self.gbx_sched_iter)
 
                 if self.gbx_sync is not None:
                     self.gbx_sync.value = (self.gbx_seq == 0)
 
-                self.gbx_bit_cnt += self.gbx_in_bits
-
                 # stall cycle
-                if self.gbx_seq in self.gbx_seq_stall:
+                if stall:
                     self.data.value = 0
                     if self.data_valid is not None:
                         self.data_valid.value = 0
@@ -272,7 +890,6 @@ class BaseRSerdesSource():
                         self.hdr_valid.value = 0
                     continue
 
-                self.gbx_bit_cnt = max(self.gbx_bit_cnt - self.gbx_out_bits, 0)
                 gbx_delay = (self.gbx_bit_cnt * clk_period) // self.gbx_in_bits
             else:
                 self.gbx_seq = 0
@@ -300,217 +917,66 @@ class BaseRSerdesSource():
 
                 continue
 
-            dl = bytearray()
-            cl = []
+            if self._tx_rd < len(self._tx_hdrs):
+                # pre-encoded block
+                hdr = self._tx_hdrs[self._tx_rd]
+                data = self._tx_blocks[self._tx_rd]
+                self._tx_rd += 1
 
-            for k in range(8):
-                if k % 4 != 0 or rep_cnt != 0 or (self.force_offset_start and k == 0) or in_term:
-                    pass
-                elif ifg_cnt + deficit_idle_cnt > 4-1 or (not self.enable_dic and ifg_cnt > 0):
-                    # in IFG
-                    ifg_cnt = ifg_cnt - 4
-                    if ifg_cnt < 0:
-                        if self.enable_dic:
-                            deficit_idle_cnt = max(deficit_idle_cnt+ifg_cnt, 0)
-                        ifg_cnt = 0
-                elif frame is None:
-                    # idle
-                    if not self.queue.empty():
-                        # send frame
-                        frame = self.queue.get_nowait()
-                        self.dequeue_event.set()
-                        self.queue_occupancy_bytes -= len(frame)
-                        self.queue_occupancy_frames -= 1
-                        self.current_frame = frame
-                        frame.sim_time_start = None
-                        frame.sim_time_sfd = None
-                        frame.sim_time_end = None
-                        self.log.info("TX frame: %s", frame)
-                        frame.normalize()
-                        frame.start_lane = 0
-                        assert frame.data[0] == EthPre.PRE
-                        assert frame.ctrl[0] == 0
-
-                        if self.enable_dic:
-                            deficit_idle_cnt = max(deficit_idle_cnt+ifg_cnt, 0)
-                        ifg_cnt = 0
-                        self.active = True
-                        frame_offset = 0
-                        sof = True
-                        in_pre = True
-                    else:
-                        # clear counters
-                        deficit_idle_cnt = 0
-                        ifg_cnt = 0
-                        self.active = False
-                        self.idle_event.set()
-
-                d = XgmiiCtrl.IDLE
-                c = 1
-                if frame is not None:
-                    if sof:
-                        sof = False
-                        d = XgmiiCtrl.START
-                        c = 1
-                        frame.start_lane = k
-                        frame.sim_time_start = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
-                    elif frame_offset >= len(frame.data):
-                        d = XgmiiCtrl.TERM
-                        c = 1
-                        in_term = True
-                        ifg_cnt = max(self.ifg - (8-k), 0)
-                        frame.sim_time_end = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
-                        frame.handle_tx_complete()
-                        frame = None
+                if self._tx_rd == len(self._tx_hdrs) or self._tx_rd >= 65536:
+                    del self._tx_blocks[:self._tx_rd]
+                    del self._tx_hdrs[:self._tx_rd]
+                    self._tx_rd = 0
+            else:
+                # 64b/66b encoding
+                hdr, data = xgmii_to_baser(*self._gen_xgmii_word())
+
+            # frame events
+            while self._tx_events and self._tx_events[0][0] <= self._tx_word_idx:
+                evt, kind, k, frame = self._tx_events.popleft()
+                t = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
+                if kind == _TX_EVT_START:
+                    if self._tx_pre_frames and self._tx_pre_frames[0][0] is frame:
+                        self._tx_pre_frames.popleft()
+                    self.dequeue_event.set()
+                    self.queue_occupancy_bytes -= len(frame)
+                    self.queue_occupancy_frames -= 1
+                    self.current_frame = frame
+                    self.active = True
+                    frame.sim_time_start = t
+                elif kind == _TX_EVT_SFD:
+                    frame.sim_time_sfd = t
+                else:
+                    frame.sim_time_end = t
+                    self.stat_frames += 1
+                    self.stat_bytes += len(frame)
+                    self.stat_busy_time += t - frame.sim_time_start
+                    frame.handle_tx_complete()
+                    if self.current_frame is frame:
                         self.current_frame = None
-                    else:
-                        d = frame.data[frame_offset]
-                        c = frame.ctrl[frame_offset]
-                        if frame.sim_time_sfd is None and not in_pre:
-                            frame.sim_time_sfd = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
-                        if d == EthPre.SFD and (not self.xgmii_rep_count or rep_cnt == 1):
-                            in_pre = False
-                        if frame_offset == 0:
-                            d = 0xAA
-                            c = 0
-
-                dl.append(d)
-                cl.append(c)
-
-                frame_offset += 1
-                if k % 4 == 3:
-                    if rep_cnt > 0:
-                        rep_cnt -= 1
-                    elif self.xgmii_rep_count:
-                        if self.xgmii_rep_count % 2 == 0 or (k != 3 if self.force_offset_start else k == 3):
-                            rep_cnt = self.xgmii_rep_count
-                    if rep_cnt > 0:
-                        frame_offset -= 4
-
-            # replace idles with ordered sets
-            if self.os is not None:
-                for k in [0, 4]:
-                    if all(cl[k:k+4]) and all(d == XgmiiCtrl.IDLE for d in dl[k:k+4]):
-                        if self.os_sig:
-                            self.log.info("TX signal ordered set: 0x%06x", self.os)
-                            dl[k] = XgmiiCtrl.SIG_OS
-                        else:
-                            self.log.info("TX sequence ordered set: 0x%06x", self.os)
-                            dl[k] = XgmiiCtrl.SEQ_OS
-                        dl[k+1:k+4] = self.os.to_bytes(3, 'big')
-                        cl[k+1:k+4] = [0, 0, 0]
 
-            in_term = False
+            self._tx_word_idx += 1
 
-            # remap control characters
-            ctrl = sum(xgmii_ctrl_to_baser_mapping.get(d, BaseRCtrl.ERROR) << i*7 for i, d in enumerate(dl))
-
-            if not any(cl):
-                # data
-                hdr = BaseRSync.DATA
-                data = int.from_bytes(dl, 'little')
-            else:
-                # control
-                hdr = BaseRSync.CTRL
-                if cl[0] and dl[0] == XgmiiCtrl.START and not any(cl[1:]):
-                    # start in lane 0
-                    data = BaseRBlockType.START_0
-                    for i in range(1, 8):
-                        data |= dl[i] << i*8
-                elif cl[4] and dl[4] == XgmiiCtrl.START and not any(cl[5:]):
-                    # start in lane 4
-                    if cl[0] and (dl[0] == XgmiiCtrl.SEQ_OS or dl[0] == XgmiiCtrl.SIG_OS) and not any(cl[1:4]):
-                        # ordered set in lane 0
-                        data = BaseRBlockType.OS_START
-                        for i in range(1, 4):
-                            data |= dl[i] << i*8
-                        if dl[0] == XgmiiCtrl.SIG_OS:
-                            # signal ordered set
-                            data |= BaseRO.SIG_OS << 32
-                    else:
-                        # other control
-                        data = BaseRBlockType.START_4 | (ctrl & 0xfffffff) << 8
-
-                    for i in range(5, 8):
-                        data |= dl[i] << i*8
-                elif cl[0] and (dl[0] == XgmiiCtrl.SEQ_OS or dl[0] == XgmiiCtrl.SIG_OS) and not any(cl[1:4]):
-                    # ordered set in lane 0
-                    if cl[4] and (dl[4] == XgmiiCtrl.SEQ_OS or dl[4] == XgmiiCtrl.SIG_OS) and not any(cl[5:8]):
-                        # ordered set in lane 4
-                        data = BaseRBlockType.OS_04
-                        for i in range(5, 8):
-                            data |= dl[i] << i*8
-                        if dl[4] == XgmiiCtrl.SIG_OS:
-                            # signal ordered set
-                            data |= BaseRO.SIG_OS << 36
-                    else:
-                        data = BaseRBlockType.OS_0 | (ctrl & 0xfffffff) << 40
-                    for i in range(1, 4):
-                        data |= dl[i] << i*8
-                    if dl[0] == XgmiiCtrl.SIG_OS:
-                        # signal ordered set
-                        data |= BaseRO.SIG_OS << 32
-                elif cl[4] and (dl[4] == XgmiiCtrl.SEQ_OS or dl[4] == XgmiiCtrl.SIG_OS) and not any(cl[5:8]):
-                    # ordered set in lane 4
-                    data = BaseRBlockType.OS_4 | (ctrl & 0xfffffff) << 8
-                    for i in range(5, 8):
-                        data |= dl[i] << i*8
-                    if dl[4] == XgmiiCtrl.SIG_OS:
-                        # signal ordered set
-                        data |= BaseRO.SIG_OS << 36
-                elif cl[0] and dl[0] == XgmiiCtrl.TERM:
-                    # terminate in lane 0
-                    data = BaseRBlockType.TERM_0 | (ctrl & 0xffffffffffff80) << 8
-                elif cl[1] and dl[1] == XgmiiCtrl.TERM and not cl[0]:
-                    # terminate in lane 1
-                    data = BaseRBlockType.TERM_1 | (ctrl & 0xffffffffffc000) << 8 | dl[0] << 8
-                elif cl[2] and dl[2] == XgmiiCtrl.TERM and not any(cl[0:2]):
-                    # terminate in lane 2
-                    data = BaseRBlockType.TERM_2 | (ctrl & 0xffffffffe00000) << 8
-                    for i in range(2):
-                        data |= dl[i] << ((i+1)*8)
-                elif cl[3] and dl[3] == XgmiiCtrl.TERM and not any(cl[0:3]):
-                    # terminate in lane 3
-                    data = BaseRBlockType.TERM_3 | (ctrl & 0xfffffff0000000) << 8
-                    for i in range(3):
-                        data |= dl[i] << ((i+1)*8)
-                elif cl[4] and dl[4] == XgmiiCtrl.TERM and not any(cl[0:4]):
-                    # terminate in lane 4
-                    data = BaseRBlockType.TERM_4 | (ctrl & 0xfffff800000000) << 8
-                    for i in range(4):
-                        data |= dl[i] << ((i+1)*8)
-                elif cl[5] and dl[5] == XgmiiCtrl.TERM and not any(cl[0:5]):
-                    # terminate in lane 5
-                    data = BaseRBlockType.TERM_5 | (ctrl & 0xfffc0000000000) << 8
-                    for i in range(5):
-                        data |= dl[i] << ((i+1)*8)
-                elif cl[6] and dl[6] == XgmiiCtrl.TERM and not any(cl[0:6]):
-                    # terminate in lane 6
-                    data = BaseRBlockType.TERM_6 | (ctrl & 0xfe000000000000) << 8
-                    for i in range(6):
-                        data |= dl[i] << ((i+1)*8)
-                elif cl[7] and dl[7] == XgmiiCtrl.TERM and not any(cl[0:7]):
-                    # terminate in lane 7
-                    data = BaseRBlockType.TERM_7
-                    for i in range(7):
-                        data |= dl[i] << ((i+1)*8)
-                else:
-                    # all control
-                    data = BaseRBlockType.CTRL | ctrl << 8
+            self.stat_blocks += 1
+            if hdr == BaseRSync.CTRL and data == BaseRBlockType.CTRL:
+                self.stat_idle_blocks += 1
 
             if self.scramble:
                 # 64b/66b scrambler
-                b = 0
-                for i in range(64):
-                    if bool(scrambler_state & (1 << 38)) ^ bool(scrambler_state & (1 << 57)) ^ bool(data & (1 << i)):
-                        scrambler_state = ((scrambler_state & 0x1ffffffffffffff) << 1) | 1
-                        b = b | (1 << i)
-                    else:
-                        scrambler_state = (scrambler_state & 0x1ffffffffffffff) << 1
-                data = b
+                if self.scramble_serial:
+                    data = scramble_64b66b_serial(data, scrambler_state)
+                else:
+                    data = scramble_64b66b(data, scrambler_state)
+                scrambler_state = data
+
+            # error injection
+            if self._err_blk == self._err_next:
+                data, hdr = self._inject_error(data, hdr)
+            self._err_blk += 1
 
             if self.slip is not None and self.slip.value:
                 self.bit_offset += 1
+                self.stat_slips += 1
 
             self.bit_offset = max(0, self.bit_offset) % 66
 
@@ -546,7 +1012,7 @@ class BaseRSerdesSink:
 
     def __init__(self, data, hdr, clock, enable=None, data_valid=None, hdr_valid=None,
             gbx_req_sync=None, gbx_req_stall=None, gbx_sync=None,
-            scramble=True, reverse=False, gbx_cfg=None, *args, **kwargs):
+            scramble=True, reverse=False, gbx_cfg=None, bank=None, *args, **kwargs):
 
         self.log = logging.getLogger(f"cocotb.{data._path}")
         self.data = data
@@ -559,6 +1025,7 @@ class BaseRSerdesSink:
         self.gbx_req_stall = gbx_req_stall
         self.gbx_sync = gbx_sync
         self.scramble = scramble
+        self.scramble_serial = False
         self.reverse = reverse
 
         self.log.info("BASE-R serdes sink")
@@ -575,6 +1042,9 @@ class BaseRSerdesSink:
         self.gbx_seq_gen = 0
         self.gbx_seq_len = None
         self.gbx_seq_stall = None
+        self.gbx_sched = None
+        self.gbx_sched_iter = None
+        self.gbx_gen_iter = None
         self.gbx_in_bits = 66
         self.gbx_out_bits = 66
         self.gbx_bit_cnt = 0
@@ -589,6 +1059,12 @@ class BaseRSerdesSink:
         self.os_match_cnt = 0
         self.idle_match_cnt = 0
 
+        self.pcap = None
+
+        self.rx_arena = None
+
+        self.clear_stats()
+
         self.width = len(self.data)
         self.byte_size = 8
         self.byte_lanes = self.width // self.byte_size
@@ -613,7 +1089,11 @@ class BaseRSerdesSink:
         if self.gbx_req_stall is not None:
             self.gbx_req_stall.setimmediatevalue(0)
 
-        self._run_cr = cocotb.start_soon(self._run())
+        if bank is not None:
+            self._run_cr = None
+            bank.add_lane(self)
+        else:
+            self._run_cr = cocotb.start_soon(self._run())
 
     def set_gbx_cfg(self, seq_len=None, seq_stall=None):
         self.log.info("Set gearbox configuration")
@@ -622,6 +1102,12 @@ class BaseRSerdesSink:
             self.log.info("Gearbox disabled")
             self.gbx_seq_len = None
             self.gbx_seq_stall = None
+            self.gbx_sched = None
+            return
+
+        if isinstance(seq_stall, int):
+            # stall count; stall cycles at the end of the sequence
+            seq_stall = range(seq_len-seq_stall, seq_len)
 
         seq_stall = sorted(list(set(seq_stall)))
 
@@ -648,13 +1134,11 @@ class BaseRSerdesSink:
         self.gbx_seq_stall = set(seq_stall)
         self.gbx_in_bits = in_bits
         self.gbx_out_bits = out_bits
-        self.gbx_bit_cnt = 0
 
-        for k in range(self.gbx_seq_len):
-            self.gbx_bit_cnt = max(self.gbx_bit_cnt - out_bits, 0)
-            if k in self.gbx_seq_stall:
-                continue
-            self.gbx_bit_cnt += in_bits
+        self.gbx_sched = gbx_schedule(seq_len, self.gbx_seq_stall, in_bits, out_bits, rx=True)
+        self.gbx_sched_iter = cycle(self.gbx_sched)
+        self.gbx_gen_iter = cycle(self.gbx_sched)
+        self.gbx_bit_cnt = self.gbx_sched[-1][2]
 
     def set_xgmii_rep_count(self, rep=0):
         self.xgmii_rep_count = int(rep)
@@ -673,6 +1157,56 @@ class BaseRSerdesSink:
     def get_idle_match(self):
         return self.idle_match_cnt > 2
 
+    def clear_stats(self):
+        self.stat_blocks = 0
+        self.stat_idle_blocks = 0
+        self.stat_sync_hdr_errors = 0
+        self.stat_block_errors = 0
+        self.stat_os = 0
+        self.stat_frames = 0
+        self.stat_bytes = 0
+        self.stat_ipg_count = 0
+        self.stat_ipg_total = 0
+        self.stat_ipg_min = None
+        self.stat_ipg_max = None
+
+    def get_stats(self):
+        return {
+            'blocks': self.stat_blocks,
+            'idle_blocks': self.stat_idle_blocks,
+            'sync_hdr_errors': self.stat_sync_hdr_errors,
+            'block_errors': self.stat_block_errors,
+            'ordered_sets': self.stat_os,
+            'frames': self.stat_frames,
+            'bytes': self.stat_bytes,
+            'ipg_min': self.stat_ipg_min,
+            'ipg_max': self.stat_ipg_max,
+            'ipg_avg': self.stat_ipg_total / self.stat_ipg_count if self.stat_ipg_count else None,
+        }
+
+    def set_rx_arena(self, size=1 << 20):
+        # receive frame data into a reusable arena and hand out frames with
+        # memoryview data instead of a new bytearray per frame.  Frames that
+        # have been dequeued are overwritten when the arena wraps around, so
+        # copy anything that needs to be kept.  size of 0 or None disables
+        if size:
+            self.rx_arena = bytearray(size)
+        else:
+            self.rx_arena = None
+
+    def _rx_arena_wrap(self, arena, start, wr):
+        # out of space; move the partial frame to the start of the arena.
+        # Switch to a new arena instead if frames are still queued, or grow
+        # it if the frame does not fit.
+        n = wr - start
+        if start == 0 or not self.queue.empty():
+            new = bytearray(len(arena)*2 if start == 0 else len(arena))
+            new[0:n] = arena[start:wr]
+            self.rx_arena = new
+            return new, 0, n
+        arena[0:n] = arena[start:wr]
+        return arena, 0, n
+
     def _recv(self, frame, compact=True):
         if self.queue.empty():
             self.active_event.clear()
@@ -690,6 +1224,20 @@ class BaseRSerdesSink:
         frame = self.queue.get_nowait()
         return self._recv(frame, compact)
 
+    async def recv_many(self, n=None, timeout=0, timeout_unit=None, compact=True):
+        # wait for at least one frame, then return up to n queued frames
+        await self.wait(timeout, timeout_unit)
+        frames = []
+        while not self.queue.empty() and (n is None or len(frames) < n):
+            frames.append(self._recv(self.queue.get_nowait(), compact))
+        return frames
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
     def count(self):
         return self.queue.qsize()
 
@@ -715,12 +1263,28 @@ class BaseRSerdesSink:
             await self.active_event.wait()
 
     async def _run(self):
+        edge = self._edge()
+        edge.send(None)
+
+        clock_edge_event = RisingEdge(self.clock)
+
+        while True:
+            await clock_edge_event
+            edge.send(get_sim_time())
+
+    def _edge(self):
+        # per-clock-edge processing, driven by _run or by a BaseRSerdesBank
         frame = None
         scrambler_state = 0
         in_pre = False
         self.active = False
 
-        clock_edge_event = RisingEdge(self.clock)
+        arena = None
+        arena_start = 0
+        arena_wr = 0
+
+        lane_idx = -8
+        last_term_idx = None
 
         clk_period = 0
         last_clk = 0
@@ -733,9 +1297,8 @@ class BaseRSerdesSink:
         skip_cnt = 0
 
         while True:
-            await clock_edge_event
+            sim_time = yield
 
-            sim_time = get_sim_time()
             if last_clk:
                 clk_period = sim_time - last_clk
             last_clk = sim_time
@@ -747,28 +1310,27 @@ class BaseRSerdesSink:
             # gearbox sequence
             if self.gbx_seq_len:
                 # generation
-                self.gbx_seq_gen = (self.gbx_seq_gen + 1) % self.gbx_seq_len
+                self.gbx_seq_gen, stall, bit_cnt = next(self.gbx_gen_iter)
 
                 if self.gbx_req_sync is not None:
                     self.gbx_req_sync.value = (self.gbx_seq_gen == 0)
 
                 # stall cycle
                 if self.gbx_req_stall is not None:
-                    self.gbx_req_stall.value = (self.gbx_seq_gen in self.gbx_seq_stall)
+                    self.gbx_req_stall.value = stall
 
                 # sync
-                self.gbx_seq = (self.gbx_seq + 1) % self.gbx_seq_len
+                self.gbx_seq, stall, self.gbx_bit_cnt = next(self.gbx_sched_iter)
 
                 if self.gbx_sync is not None:
-                    if int(self.gbx_sync.value):
-                        self.gbx_seq = 0
+                    if self.gbx_seq and int(self.gbx_sync.value):
+                        # restart sequence
+                        self.gbx_sched_iter = cycle(self.gbx_sched)
+                        self.gbx_seq, stall, self.gbx_bit_cnt = self.gbx_sched[-1]
 
-                self.gbx_bit_cnt = max(self.gbx_bit_cnt - self.gbx_out_bits, 0)
-
-                if self.gbx_seq in self.gbx_seq_stall:
+                if stall:
                     continue
 
-                self.gbx_bit_cnt += self.gbx_in_bits
                 gbx_delay = (self.gbx_bit_cnt * clk_period) // self.gbx_out_bits
             else:
                 self.gbx_seq = 0
@@ -819,172 +1381,61 @@ class BaseRSerdesSink:
 
             if self.scramble:
                 # 64b/66b descrambler
-                b = 0
-                for i in range(64):
-                    if bool(scrambler_state & (1 << 38)) ^ bool(scrambler_state & (1 << 57)) ^ bool(data & (1 << i)):
-                        b = b | (1 << i)
-                    scrambler_state = (scrambler_state & 0x1ffffffffffffff) << 1 | bool(data & (1 << i))
+                if self.scramble_serial:
+                    b = descramble_64b66b_serial(data, scrambler_state)
+                else:
+                    b = descramble_64b66b(data, scrambler_state)
+                scrambler_state = data
                 data = b
 
             # 10GBASE-R decoding
+            d, cl, os, err = baser_to_xgmii(hdr, data)
 
-            # remap control characters
-            ctrl = bytearray(baser_ctrl_to_xgmii_mapping.get((data >> i*7+8) & 0x7f, XgmiiCtrl.ERROR) for i in range(8))
+            self.stat_blocks += 1
+            lane_idx += 8
 
-            db = data.to_bytes(8, 'little')
+            if err:
+                self.log.warning(err)
+                if hdr != BaseRSync.DATA and hdr != BaseRSync.CTRL:
+                    self.stat_sync_hdr_errors += 1
+                else:
+                    self.stat_block_errors += 1
 
-            dl = bytearray()
-            cl = []
-            os = False
             if hdr == BaseRSync.DATA:
-                # data
-                dl = db
-                cl = [0]*8
                 if frame is None:
                     self.log.warning("Data transfer outside of frame")
-            elif hdr == BaseRSync.CTRL:
-                if db[0] == BaseRBlockType.CTRL:
-                    # C7 C6 C5 C4 C3 C2 C1 C0 BT
-                    dl = ctrl
-                    cl = [1]*8
-                    self.os_match_cnt = 0
-                    self.idle_match_cnt += 1
-                elif db[0] == BaseRBlockType.OS_4:
-                    # D7 D6 D5 O4 C3 C2 C1 C0 BT
-                    dl = ctrl[0:4]
-                    cl = [1]*4
-                    os = True
-                    if (db[4] >> 4) & 0xf == BaseRO.SEQ_OS:
-                        dl.append(XgmiiCtrl.SEQ_OS)
-                    elif (db[4] >> 4) & 0xf == BaseRO.SIG_OS:
-                        dl.append(XgmiiCtrl.SIG_OS)
-                    else:
-                        self.log.warning("Invalid O code")
-                        dl.append(XgmiiCtrl.ERROR)
-                    cl.append(1)
-                    dl += db[5:]
-                    cl += [0]*3
-                elif db[0] == BaseRBlockType.START_4:
-                    # D7 D6 D5    C3 C2 C1 C0 BT
-                    dl = ctrl[0:4]
-                    cl = [1]*4
-                    dl.append(XgmiiCtrl.START)
-                    cl.append(1)
-                    dl += db[5:]
-                    cl += [0]*3
-                elif db[0] == BaseRBlockType.OS_START:
-                    # D7 D6 D5    O0 D3 D2 D1 BT
-                    os = True
-                    if db[4] & 0xf == BaseRO.SEQ_OS:
-                        dl.append(XgmiiCtrl.SEQ_OS)
-                    elif db[4] & 0xf == BaseRO.SIG_OS:
-                        dl.append(XgmiiCtrl.SIG_OS)
-                    else:
-                        self.log.warning("Invalid O code")
-                        dl.append(XgmiiCtrl.ERROR)
-                    cl.append(1)
-                    dl += db[1:4]
-                    cl += [0]*3
-                    dl.append(XgmiiCtrl.START)
-                    cl.append(1)
-                    dl += db[5:]
-                    cl += [0]*3
-                elif db[0] == BaseRBlockType.OS_04:
-                    # D7 D6 D5 O4 O0 D3 D2 D1 BT
-                    os = True
-                    if db[4] & 0xf == BaseRO.SEQ_OS:
-                        dl.append(XgmiiCtrl.SEQ_OS)
-                    elif db[4] & 0xf == BaseRO.SIG_OS:
-                        dl.append(XgmiiCtrl.SIG_OS)
-                    else:
-                        self.log.warning("Invalid O code")
-                        dl.append(XgmiiCtrl.ERROR)
-                    cl.append(1)
-                    dl += db[1:4]
-                    cl += [0]*3
-                    if (db[4] >> 4) & 0xf == BaseRO.SEQ_OS:
-                        dl.append(XgmiiCtrl.SEQ_OS)
-                    elif (db[4] >> 4) & 0xf == BaseRO.SIG_OS:
-                        dl.append(XgmiiCtrl.SIG_OS)
-                    else:
-                        self.log.warning("Invalid O code")
-                        dl.append(XgmiiCtrl.ERROR)
-                    cl.append(1)
-                    dl += db[5:]
-                    cl += [0]*3
-                elif db[0] == BaseRBlockType.START_0:
-                    # D7 D6 D5 D4 D3 D2 D1    BT
-                    dl.append(XgmiiCtrl.START)
-                    cl.append(1)
-                    dl += db[1:]
-                    cl += [0]*7
-                elif db[0] == BaseRBlockType.OS_0:
-                    # C7 C6 C5 C4 O0 D3 D2 D1 BT
-                    os = True
-                    if db[4] & 0xf == BaseRO.SEQ_OS:
-                        dl.append(XgmiiCtrl.SEQ_OS)
-                    elif db[4] & 0xf == BaseRO.SIG_OS:
-                        dl.append(XgmiiCtrl.SIG_OS)
-                    else:
-                        self.log.warning("Invalid O code")
-                        dl.append(XgmiiCtrl.ERROR)
-                    cl.append(1)
-                    dl += db[1:4]
-                    cl += [0]*3
-                    dl += ctrl[4:]
-                    cl += [1]*4
-                elif db[0] in {BaseRBlockType.TERM_0, BaseRBlockType.TERM_1,
-                        BaseRBlockType.TERM_2, BaseRBlockType.TERM_3, BaseRBlockType.TERM_4,
-                        BaseRBlockType.TERM_5, BaseRBlockType.TERM_6, BaseRBlockType.TERM_7}:
-                    # C7 C6 C5 C4 C3 C2 C1    BT
-                    # C7 C6 C5 C4 C3 C2    D0 BT
-                    # C7 C6 C5 C4 C3    D1 D0 BT
-                    # C7 C6 C5 C4    D2 D1 D0 BT
-                    # C7 C6 C5    D3 D2 D1 D0 BT
-                    # C7 C6    D4 D3 D2 D1 D0 BT
-                    # C7    D5 D4 D3 D2 D1 D0 BT
-                    #    D6 D5 D4 D3 D2 D1 D0 BT
-                    term_lane = block_type_term_lane_mapping[db[0]]
-                    dl += db[1:term_lane+1]
-                    cl += [0]*term_lane
-                    dl.append(XgmiiCtrl.TERM)
-                    cl.append(1)
-                    dl += ctrl[term_lane+1:]
-                    cl += [1]*(7-term_lane)
-                else:
-                    # invalid block type
-                    self.log.warning("Invalid block type")
-                    dl = [XgmiiCtrl.ERROR]*8
-                    cl = [1]*8
-            else:
-                # invalid sync header
-                self.log.warning("Invalid sync header")
-                dl = [XgmiiCtrl.ERROR]*8
-                cl = [1]*8
+            elif hdr == BaseRSync.CTRL and data & 0xff == BaseRBlockType.CTRL:
+                self.os_match_cnt = 0
+                self.idle_match_cnt += 1
+                if data == BaseRBlockType.CTRL:
+                    self.stat_idle_blocks += 1
+
+            dl = d.to_bytes(8, 'little')
 
             # extract ordered sets
             if os:
                 for k in [0, 4]:
                     os_sig = dl[k] == XgmiiCtrl.SIG_OS
-                    if cl[k] and (dl[k] == XgmiiCtrl.SEQ_OS or os_sig):
-                        v = int.from_bytes(db[k+1:k+4], 'big')
+                    if (cl >> k) & 1 and (dl[k] == XgmiiCtrl.SEQ_OS or os_sig):
+                        v = int.from_bytes(dl[k+1:k+4], 'big')
                         if self.os == v and self.os_sig == os_sig:
                             self.os_match_cnt += 1
                         self.idle_match_cnt = 0
                         self.os = v
                         self.os_sig = os_sig
+                        self.stat_os += 1
                         if os_sig:
                             self.log.info("RX signal ordered set: 0x%06x", self.os)
                         else:
                             self.log.info("RX sequence ordered set: 0x%06x", self.os)
 
             if frame is None:
-                if cl[0] == 0:
+                if not cl & 1:
                     self.log.warning("Data transfer outside of frame")
 
             for k in range(8):
                 d_val = dl[k]
-                c_val = cl[k]
+                c_val = (cl >> k) & 1
 
                 # USXGMII sync
                 if self.xgmii_rep_count:
@@ -1003,25 +1454,62 @@ class BaseRSerdesSink:
                 if frame is None:
                     if c_val and d_val == XgmiiCtrl.START:
                         # start
-                        frame = XgmiiFrame(bytearray([EthPre.PRE]), [0])
+                        if self.rx_arena is None:
+                            arena = None
+                            frame = XgmiiFrame(bytearray([EthPre.PRE]), [0])
+                        else:
+                            if arena is not self.rx_arena:
+                                arena = self.rx_arena
+                                arena_wr = 0
+                            arena_start = arena_wr
+                            if arena_wr >= len(arena):
+                                arena, arena_start, arena_wr = self._rx_arena_wrap(arena, arena_start, arena_wr)
+                            arena[arena_wr] = EthPre.PRE
+                            arena_wr += 1
+                            frame = XgmiiViewFrame(bytearray(), [0])
                         frame.sim_time_start = sim_time + (clk_period // self.byte_lanes * k) + gbx_delay
                         frame.start_lane = k
                         in_pre = True
+
+                        # inter-packet gap, in lanes from terminate to start
+                        if last_term_idx is not None:
+                            ipg = lane_idx + k - last_term_idx
+                            self.stat_ipg_count += 1
+                            self.stat_ipg_total += ipg
+                            if self.stat_ipg_min is None or ipg < self.stat_ipg_min:
+                                self.stat_ipg_min = ipg
+                            if self.stat_ipg_max is None or ipg > self.stat_ipg_max:
+                                self.stat_ipg_max = ipg
                 else:
                     if c_val:
                         # got a control character; terminate frame reception
                         if d_val != XgmiiCtrl.TERM:
                             # store control character if it's not a termination
-                            frame.data.append(d_val)
+                            if arena is None:
+                                frame.data.append(d_val)
+                            else:
+                                if arena_wr >= len(arena):
+                                    arena, arena_start, arena_wr = self._rx_arena_wrap(arena, arena_start, arena_wr)
+                                arena[arena_wr] = d_val
+                                arena_wr += 1
                             frame.ctrl.append(c_val)
 
+                        if arena is not None:
+                            frame.data = memoryview(arena)[arena_start:arena_wr]
+
                         frame.compact()
                         frame.sim_time_end = sim_time + (clk_period // self.byte_lanes * k) + gbx_delay
+                        last_term_idx = lane_idx + k
+                        self.stat_frames += 1
+                        self.stat_bytes += len(frame)
                         self.log.info("RX frame: %s", frame)
 
                         self.queue_occupancy_bytes += len(frame)
                         self.queue_occupancy_frames += 1
 
+                        if self.pcap is not None:
+                            self.pcap.write_frame(frame)
+
                         self.queue.put_nowait(frame)
                         self.active_event.set()
 
@@ -1032,5 +1520,233 @@ class BaseRSerdesSink:
                         if d_val == EthPre.SFD:
                             in_pre = False
 
-                        frame.data.append(d_val)
+                        if arena is None:
+                            frame.data.append(d_val)
+                        else:
+                            if arena_wr >= len(arena):
+                                arena, arena_start, arena_wr = self._rx_arena_wrap(arena, arena_start, arena_wr)
+                            arena[arena_wr] = d_val
+                            arena_wr += 1
                         frame.ctrl.append(c_val)
+
+
+class BaseRSerdesBank:
+
+    def __init__(self, clock, *args, **kwargs):
+        self.log = logging.getLogger(f"cocotb.{clock._path}")
+        self.clock = clock
+
+        self.log.info("BASE-R serdes bank")
+        self.log.info("Copyright (c) 2021-2025 FPGA Ninja, LLC")
+        self.log.info("https://github.com/fpganinja/taxi")
+
+        super().__init__(*args, **kwargs)
+
+        self.lanes = []
+        self._edges = []
+
+        self._run_cr = None
+
+    def add_lane(self, lane):
+        # lanes are serviced in the order they are added
+        if lane.clock is not self.clock:
+            raise ValueError(f"Lane {lane.data._path} clock does not match bank clock {self.clock._path}")
+
+        edge = lane._edge()
+        edge.send(None)
+
+        self.lanes.append(lane)
+        self._edges.append(edge)
+
+        self.log.info("Add lane %d: %s", len(self.lanes)-1, lane.data._path)
+
+        if self._run_cr is None:
+            self._run_cr = cocotb.start_soon(self._run())
+
+    def add_source(self, data, hdr, *args, **kwargs):
+        return BaseRSerdesSource(data, hdr, self.clock, *args, bank=self, **kwargs)
+
+    def add_sink(self, data, hdr, *args, **kwargs):
+        return BaseRSerdesSink(data, hdr, self.clock, *args, bank=self, **kwargs)
+
+    async def _run(self):
+        edges = self._edges
+
+        clock_edge_event = RisingEdge(self.clock)
+
+        while True:
+            await clock_edge_event
+
+            sim_time = get_sim_time()
+
+            for edge in edges:
+                edge.send(sim_time)
+
+
+class PcapngWriter:
+
+    def __init__(self, f, snaplen=65535, fcs=True, buffer_size=1 << 20):
+        # f is a path or a binary file object
+        if isinstance(f, (str, os.PathLike)):
+            self.file = open(f, 'wb')
+            self.close_file = True
+        else:
+            self.file = f
+            self.close_file = False
+
+        self.snaplen = snaplen
+        self.fcs = fcs
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+        self.frame_count = 0
+        # frames written raw because the preamble could not be parsed
+        self.raw_frame_count = 0
+
+        # section header block
+        self._write_block(0x0A0D0D0A, struct.pack('<LHHq', 0x1A2B3C4D, 1, 0, -1))
+
+        # interface description block, Ethernet, timestamps in ps
+        opts = self._opt(9, bytes([12]))
+        if fcs:
+            opts += self._opt(13, bytes([4]))
+        opts += self._opt(0, b'')
+        self._write_block(0x00000001, struct.pack('<HHL', 1, 0, snaplen) + opts)
+
+    @staticmethod
+    def _opt(code, value):
+        return struct.pack('<HH', code, len(value)) + value + bytes(-len(value) % 4)
+
+    def _write_block(self, block_type, body):
+        length = len(body) + 12
+        self.buffer += struct.pack('<LL', block_type, length)
+        self.buffer += body
+        self.buffer += struct.pack('<L', length)
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write(self, data, timestamp=0, comment=None):
+        # timestamp in ps
+        cap = data[:self.snaplen]
+        body = struct.pack('<LLLLL', 0, (timestamp >> 32) & 0xffffffff, timestamp & 0xffffffff, len(cap), len(data))
+        body += cap + bytes(-len(cap) % 4)
+        if comment:
+            body += self._opt(1, comment.encode()) + self._opt(0, b'')
+        self._write_block(0x00000006, body)
+        self.frame_count += 1
+
+    def write_frame(self, frame):
+        # write a received or transmitted frame, using the model timestamps
+        try:
+            data = bytes(frame.get_payload(strip_fcs=not self.fcs))
+            raw = False
+        except ValueError:
+            # no SFD (e.g. truncated by an error); write the raw bytes
+            data = bytes(frame.data)
+            raw = True
+            self.raw_frame_count += 1
+
+        times = {}
+        for name, t in [("start", frame.sim_time_start), ("sfd", frame.sim_time_sfd), ("end", frame.sim_time_end)]:
+            if t is not None:
+                times[name] = int(get_time_from_sim_steps(t, 'ps'))
+
+        comment = " ".join(f"{name}={t}" for name, t in times.items())
+        if raw:
+            comment = (comment + " raw").strip()
+
+        self.write(data, times.get("start", 0), comment)
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.close_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PcapReader:
+
+    def __init__(self, f):
+        # f is a path; the file is memory-mapped and records are parsed on demand
+        self.file = open(f, 'rb')
+        self.mm = None
+
+        if os.fstat(self.file.fileno()).st_size < 24:
+            self.close()
+            raise ValueError("Not a pcap file")
+
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.close()
+            raise
+
+        # byte order and ps per timestamp fraction unit (us or ns)
+        magic = {
+            b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+            b'\x4d\x3c\xb2\xa1': ('<', 1000),
+            b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+            b'\xa1\xb2\x3c\x4d': ('>', 1000),
+        }.get(self.mm[0:4])
+
+        if magic is None:
+            self.close()
+            raise ValueError("Not a pcap file")
+
+        self.endian, self.ts_scale = magic
+        self.snaplen, self.linktype = struct.unpack_from(self.endian+'LL', self.mm, 16)
+
+        if self.linktype != 1:
+            self.close()
+            raise ValueError(f"Unsupported pcap link type {self.linktype} (expected 1, Ethernet)")
+
+        self._rec_hdr = struct.Struct(self.endian+'LLLL')
+
+    def __iter__(self):
+        # yields (timestamp in ps, packet data)
+        mm = self.mm
+        rec_hdr = self._rec_hdr
+        offset = 24
+        end = len(mm)
+
+        while offset < end:
+            if offset + 16 > end:
+                raise ValueError(f"Truncated pcap record header at offset {offset}")
+            ts_sec, ts_frac, cap_len, orig_len = rec_hdr.unpack_from(mm, offset)
+            offset += 16
+            if offset + cap_len > end:
+                raise ValueError(f"Truncated pcap record at offset {offset-16}")
+            yield ts_sec*1000000000000 + ts_frac*self.ts_scale, mm[offset:offset+cap_len]
+            offset += cap_len
+
+    def frames(self, fcs=False):
+        # generate frames for BaseRSerdesSource.feed(); captures without
+        # FCS are padded and get a computed FCS
+        for ts, data in self:
+            if fcs:
+                yield XgmiiFrame.from_raw_payload(data)
+            else:
+                yield XgmiiFrame.from_payload(data)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -10,6 +10,8 @@ Authors:
 """
 
 import logging
+from array import array
+from itertools import cycle
 
 import cocotb
 from cocotb.queue import Queue, QueueFull
@@ -108,6 +110,141 @@ def rd_flip_8b10b(d, k):
     return rd_flip_5b6b(d & 0x1f, k) ^ rd_flip_3b4b(d >> 5)
 
 
+# 5b/6b codes (abcdei) for RD-, RD+ code is the complement for
+# unbalanced codes and D.07
+_code_5b6b = [
+    '100111', '011101', '101101', '110001', '110101', '101001', '011001', '111000',
+    '111001', '100101', '010101', '110100', '001101', '101100', '011100', '010111',
+    '011011', '100011', '010011', '110010', '001011', '101010', '011010', '111010',
+    '110011', '100110', '010110', '110110', '001110', '101110', '011110', '101011',
+]
+
+# 3b/4b codes (fghj) for RD-, data codes use the primary code for .7
+_code_3b4b_d = ['1011', '1001', '0101', '1100', '1101', '1010', '0110', '1110']
+_code_3b4b_k = ['1011', '0110', '1010', '1100', '1101', '0101', '1001', '0111']
+
+_valid_k_8b10b = {0x1c, 0x3c, 0x5c, 0x7c, 0x9c, 0xbc, 0xdc, 0xfc, 0xf7, 0xfb, 0xfd, 0xfe}
+
+# decode table flags
+_DEC_8B10B_K = 1 << 8
+_DEC_8B10B_CV = 1 << 13
+
+
+def _invert_code(code):
+    return code.translate(str.maketrans('01', '10'))
+
+
+def _sub_block_rd(val, n, rd):
+    # RD after a sub-block of n bits, first bit (a or f) in bit 0
+    ones = bin(val).count('1')
+    if ones*2 > n:
+        return 1
+    if ones*2 < n:
+        return 0
+    # 000111 and 0011 end with RD+, 111000 and 1100 end with RD-
+    if val == (0b111000 if n == 6 else 0b1100):
+        return 1
+    if val == (0b000111 if n == 6 else 0b0011):
+        return 0
+    return rd
+
+
+def _enc_8b10b(d, k, rd):
+    x = d & 0x1f
+    y = d >> 5
+
+    c6 = '001111' if k and x == 28 else _code_5b6b[x]
+    if rd and (c6.count('1') != 3 or c6 == '111000'):
+        c6 = _invert_code(c6)
+    s6 = int(c6[::-1], 2)
+    rd = _sub_block_rd(s6, 6, rd)
+
+    if k:
+        c4 = _code_3b4b_k[y]
+        if rd:
+            c4 = _invert_code(c4)
+    else:
+        if y == 7 and ((not rd and x in (17, 18, 20)) or (rd and x in (11, 13, 14))):
+            # alternate code to avoid a run of five
+            c4 = '0111'
+        else:
+            c4 = _code_3b4b_d[y]
+        if rd and (c4.count('1') != 2 or c4 == '1100'):
+            c4 = _invert_code(c4)
+    s4 = int(c4[::-1], 2)
+    rd = _sub_block_rd(s4, 4, rd)
+
+    return s6 | s4 << 6, rd
+
+
+def _build_8b10b_tables():
+    # encode table, indexed by K << 8 | data
+    # bits 0-9: symbol for RD-, bits 10-19: symbol for RD+, bit 20: RD flip
+    enc = [0]*512
+
+    # decode table, indexed by symbol
+    # bits 0-7: data, bit 8: K, bits 9-10: valid for RD-/RD+,
+    # bits 11-12: RD after symbol for RD-/RD+, bit 13: code violation
+    dec = [_DEC_8B10B_CV | _DEC_8B10B_K | XgmiiCtrl.ERROR]*1024
+
+    for kd in range(512):
+        d = kd & 0xff
+        k = kd >> 8
+        if k and d not in _valid_k_8b10b:
+            # invalid control code, send as data
+            enc[kd] = enc[d]
+            continue
+
+        s0, rd0 = _enc_8b10b(d, k, 0)
+        s1, rd1 = _enc_8b10b(d, k, 1)
+        assert rd0 == rd_flip_8b10b(d, k) and rd1 == rd0 ^ 1
+        enc[kd] = s0 | s1 << 10 | rd0 << 20
+
+        for rd, sym in [(0, s0), (1, s1)]:
+            dec[sym] = (dec[sym] & 0x600) | kd | 1 << (9+rd)
+
+    for sym in range(1024):
+        for rd in range(2):
+            rd_next = _sub_block_rd(sym >> 6, 4, _sub_block_rd(sym & 0x3f, 6, rd))
+            dec[sym] |= rd_next << (11+rd)
+
+    return enc, dec
+
+
+_enc_8b10b_table, _dec_8b10b_table = _build_8b10b_tables()
+
+
+def gbx_schedule(seq_len, seq_stall, in_bits, out_bits, rx=False):
+    # precompute cyclic gearbox schedule
+    # returns one (seq, stall, bit_cnt) entry per cycle, starting at
+    # sequence step 1; bit_cnt is the numerator of the gearbox delay
+    steps = list(range(seq_len))
+    bit_cnt = 0
+    sched = None
+
+    # one pass from step 0 primes the bit count, then repeat from step 1
+    # until the bit count settles into a periodic pattern
+    for n in range(16):
+        prev = sched
+        sched = []
+        for seq in steps:
+            stall = seq in seq_stall
+            if rx:
+                bit_cnt = max(bit_cnt - out_bits, 0)
+                if not stall:
+                    bit_cnt += in_bits
+            else:
+                bit_cnt += in_bits
+                if not stall:
+                    bit_cnt = max(bit_cnt - out_bits, 0)
+            sched.append((seq, stall, bit_cnt))
+        if sched == prev:
+            break
+        steps = list(range(1, seq_len)) + [0]
+
+    return sched
+
+
 class BaseXSerdesSource():
 
     def __init__(self, data, clock, data_k=None, enable=None, slip=None, data_valid=None,
@@ -146,6 +283,8 @@ class BaseXSerdesSource():
         self.gbx_seq = 0
         self.gbx_seq_len = None
         self.gbx_seq_stall = None
+        self.gbx_sched = None
+        self.gbx_sched_iter = None
         self.gbx_in_bits = 10
         self.gbx_out_bits = 10
         self.gbx_bit_cnt = 0
@@ -161,7 +300,7 @@ class BaseXSerdesSource():
         self.an_cfg = None
 
         self.width = len(self.data)
-        self.byte_size = 8
+        self.byte_size = 10 if self.enc_8b10b else 8
         self.byte_lanes = self.width // self.byte_size
 
         self.data_mask = (2**self.width)-1
@@ -196,9 +335,15 @@ class BaseXSerdesSource():
             self.gbx_bit_cnt = 0
             self.gbx_seq_len = None
             self.gbx_seq_stall = None
+            self.gbx_sched = None
             self.gbx_in_bits = 10
             self.gbx_out_bits = 10
             self.gbx_seq = 0
+            return
+
+        if isinstance(seq_stall, int):
+            # stall count; stall cycles at the end of the sequence
+            seq_stall = range(seq_len-seq_stall, seq_len)
 
         seq_stall = sorted(list(set(seq_stall)))
 
@@ -224,20 +369,17 @@ class BaseXSerdesSource():
         self.gbx_seq_stall = set(seq_stall)
         self.gbx_in_bits = in_bits
         self.gbx_out_bits = out_bits
-        self.gbx_bit_cnt = 0
 
-        for k in range(self.gbx_seq_len):
-            self.gbx_bit_cnt += in_bits
-            if k in self.gbx_seq_stall:
-                continue
-            self.gbx_bit_cnt = max(self.gbx_bit_cnt - out_bits, 0)
+        self.gbx_sched = gbx_schedule(seq_len, self.gbx_seq_stall, in_bits, out_bits)
+        self.gbx_sched_iter = cycle(self.gbx_sched)
+        self.gbx_bit_cnt = self.gbx_sched[-1][2]
 
     async def send(self, frame):
         while self.full():
             self.dequeue_event.clear()
             await self.dequeue_event.wait()
         frame = GmiiFrame(frame)
-        await self.queue.put(frame)
+        await self.queue.put(self._prep_frame(frame))
         self.idle_event.clear()
         self.queue_occupancy_bytes += len(frame)
         self.queue_occupancy_frames += 1
@@ -246,11 +388,29 @@ class BaseXSerdesSource():
         if self.full():
             raise QueueFull()
         frame = GmiiFrame(frame)
-        self.queue.put_nowait(frame)
+        self.queue.put_nowait(self._prep_frame(frame))
         self.idle_event.clear()
         self.queue_occupancy_bytes += len(frame)
         self.queue_occupancy_frames += 1
 
+    def _prep_frame(self, frame):
+        # convert frame to symbols (k << 8 | d) once, up front
+        syms = array('H', list(frame.data))
+
+        if frame.error is not None:
+            n = len(syms)
+            err = frame.error[:n] + [frame.error[-1]]*(n-len(frame.error))
+            for i in range(n):
+                if err[i]:
+                    syms[i] = 0x100 | XgmiiCtrl.ERROR # /V/
+
+        # SFD position, for timestamping
+        sfd = frame.data.find(EthPre.SFD)
+        if sfd < 0:
+            sfd = len(syms)
+
+        return frame, syms, sfd
+
     def count(self):
         return self.queue.qsize()
 
@@ -270,7 +430,7 @@ class BaseXSerdesSource():
 
     def clear(self):
         while not self.queue.empty():
-            frame = self.queue.get_nowait()
+            frame = self.queue.get_nowait()[0]
             frame.sim_time_end = None
             frame.handle_tx_complete()
         self.dequeue_event.set()
@@ -293,12 +453,14 @@ class BaseXSerdesSource():
 
     async def _run(self):
         frame = None
+        frame_syms = None
+        frame_sfd = 0
+        frame_len = 0
         frame_offset = 0
         rd = False
         odd = False
         carrier_extend = False
         sof = False
-        in_pre = False
         ifg_cnt = 0
         deficit_idle_cnt = 0
         last_d = 0
@@ -332,15 +494,13 @@ class BaseXSerdesSource():
 
             # gearbox sequence
             if self.gbx_seq_len:
-                self.gbx_seq = (self.gbx_seq + 1) % self.gbx_seq_len
+                self.gbx_seq, stall, self.gbx_bit_cnt = next(self.gbx_sched_iter)
 
                 if self.gbx_sync is not None:
                     self.gbx_sync.value = (self.gbx_seq == 0)
 
-                self.gbx_bit_cnt += self.gbx_in_bits
-
                 # stall cycle
-                if self.gbx_seq in self.gbx_seq_stall:
+                if stall:
                     self.data.value = 0
                     if self.data_k is not None:
                         self.data_k.value = 0
@@ -348,7 +508,6 @@ class BaseXSerdesSource():
                         self.data_valid.value = 0
                     continue
 
-                self.gbx_bit_cnt = max(self.gbx_bit_cnt - self.gbx_out_bits, 0)
                 gbx_delay = (self.gbx_bit_cnt * clk_period) // self.gbx_in_bits
             else:
                 self.gbx_seq = 0
@@ -361,89 +520,26 @@ class BaseXSerdesSource():
             data = 0
             data_k = 0
 
-            for k in range(self.byte_lanes):
-                # idle
-                if not odd:
-                    d_val = 0xBC # /K28.5/
-                    k_val = True
-                elif rd:
-                    # /I1/
-                    d_val = 0xC5 # /D5.6/
-                    k_val = False
-                else:
-                    # /I2/
-                    d_val = 0x50 # /D16.2/
-                    k_val = False
+            rep_count = self.gmii_rep_count
 
-                if carrier_extend:
-                    # /R/
-                    d_val = 0xF7 # (/K23.7/)
-                    k_val = True
-
-                    if odd:
+            for k in range(self.byte_lanes):
+                if frame is not None and not sof and not an_cfg:
+                    # in frame; symbols are precomputed, replicated symbols
+                    # are repeated reads of the same entry
+                    if carrier_extend and odd:
                         carrier_extend = False
 
-                if frame is None:
-                    if ifg_cnt > 1 or (not self.enable_dic and ifg_cnt > 0) or odd or rep_cnt != 0:
-                        # in IFG
-                        pass
+                    if rep_cnt == 0:
+                        frame_offset += 1
 
+                    if frame_offset < frame_len:
+                        # /Dx.y/ or /V/
+                        sym = frame_syms[frame_offset]
+                        if frame_offset > frame_sfd and frame.sim_time_sfd is None:
+                            frame.sim_time_sfd = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
                     else:
-                        # eligible to start
-                        if not self.queue.empty():
-                            # send frame
-                            frame = self.queue.get_nowait()
-                            self.dequeue_event.set()
-                            self.queue_occupancy_bytes -= len(frame)
-                            self.queue_occupancy_frames -= 1
-                            self.current_frame = frame
-                            frame.sim_time_start = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
-                            frame.sim_time_sfd = None
-                            frame.sim_time_end = None
-                            self.log.info("TX frame: %s", frame)
-                            frame.normalize()
-                            assert frame.data[0] == EthPre.PRE
-
-                            if self.enable_dic:
-                                deficit_idle_cnt = ifg_cnt
-                            ifg_cnt = 0
-                            self.active = True
-                            frame_offset = 0
-                            sof = True
-                            in_pre = True
-                        else:
-                            # nothing to send
-                            self.active = False
-                            self.idle_event.set()
-
-                    if frame is None:
-                        # idle
-                        if rep_cnt > 0:
-                            pass
-                        elif ifg_cnt > 0:
-                            ifg_cnt -= 1
-                        elif deficit_idle_cnt > 0:
-                            deficit_idle_cnt -= 1
-
-                if an_cfg:
-                    d_val = an_cfg.pop(0)
-                    k_val = False
-                elif frame is not None:
-                    if rep_cnt == 0 and not sof:
-                        frame_offset += 1
-                    if sof:
-                        # /S/
-                        d_val = XgmiiCtrl.START # /K27.7/
-                        k_val = True
-                        if self.truncate_preamble:
-                            if self.gmii_rep_count:
-                                rep_cnt = self.gmii_rep_count
-                            else:
-                                frame_offset += 1
-                    elif frame_offset >= len(frame.data):
                         # /T/
-                        d_val = XgmiiCtrl.TERM # /K29.7/
-                        k_val = True
+                        sym = 0x100 | XgmiiCtrl.TERM # /K29.7/
                         carrier_extend = True
 
                         ifg_cnt = max(self.ifg + deficit_idle_cnt - 1, 0)
@@ -451,46 +547,102 @@ class BaseXSerdesSource():
                         frame.handle_tx_complete()
                         frame = None
                         self.current_frame = None
+                else:
+                    # idle
+                    if not odd:
+                        sym = 0x1BC # /K28.5/
+                    elif rd:
+                        # /I1/
+                        sym = 0xC5 # /D5.6/
                     else:
-                        d = frame.data[frame_offset]
-                        if frame.sim_time_sfd is None and not in_pre:
-                            frame.sim_time_sfd = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
-                        if d == EthPre.SFD and (not self.gmii_rep_count or rep_cnt == 1):
-                            in_pre = False
-                        if frame.error[frame_offset]:
-                            # /V/
-                            d_val = XgmiiCtrl.ERROR # /K30.7/
-                            k_val = True
+                        # /I2/
+                        sym = 0x50 # /D16.2/
+
+                    if carrier_extend:
+                        # /R/
+                        sym = 0x1F7 # (/K23.7/)
+
+                        if odd:
+                            carrier_extend = False
+
+                    if frame is None:
+                        if ifg_cnt > 1 or (not self.enable_dic and ifg_cnt > 0) or odd or rep_cnt != 0:
+                            # in IFG
+                            pass
+
                         else:
-                            d_val = d # /Dx.y/
-                            k_val = False
-                    sof = False
-                elif self.an_cfg is not None and odd:
-                    self.log.info("TX config reg: 0x%04x", self.an_cfg)
-                    an_cfg = [self.an_cfg & 0xff, (self.an_cfg >> 8) & 0xff]
-                    if an_phase:
-                        d_val = 0x42
-                    else:
-                        d_val = 0xb5
-                    k_val = False
-                    an_phase = not an_phase
+                            # eligible to start
+                            if not self.queue.empty():
+                                # send frame
+                                frame, frame_syms, frame_sfd = self.queue.get_nowait()
+                                frame_len = len(frame_syms)
+                                self.dequeue_event.set()
+                                self.queue_occupancy_bytes -= frame_len
+                                self.queue_occupancy_frames -= 1
+                                self.current_frame = frame
+                                frame.sim_time_start = sim_time + (clk_period // self.byte_lanes * k) - gbx_delay
+                                frame.sim_time_sfd = None
+                                frame.sim_time_end = None
+                                self.log.info("TX frame: %s", frame)
+                                frame.normalize()
+                                assert frame.data[0] == EthPre.PRE
+
+                                if self.enable_dic:
+                                    deficit_idle_cnt = ifg_cnt
+                                ifg_cnt = 0
+                                self.active = True
+                                frame_offset = 0
+                                sof = True
+                            else:
+                                # nothing to send
+                                self.active = False
+                                self.idle_event.set()
+
+                        if frame is None:
+                            # idle
+                            if rep_cnt > 0:
+                                pass
+                            elif ifg_cnt > 0:
+                                ifg_cnt -= 1
+                            elif deficit_idle_cnt > 0:
+                                deficit_idle_cnt -= 1
+
+                    if an_cfg:
+                        sym = an_cfg.pop(0)
+                    elif sof:
+                        # /S/
+                        sym = 0x100 | XgmiiCtrl.START # /K27.7/
+                        if self.truncate_preamble:
+                            if rep_count:
+                                rep_cnt = rep_count
+                            else:
+                                frame_offset += 1
+                        sof = False
+                    elif self.an_cfg is not None and odd:
+                        self.log.info("TX config reg: 0x%04x", self.an_cfg)
+                        an_cfg = [self.an_cfg & 0xff, (self.an_cfg >> 8) & 0xff]
+                        if an_phase:
+                            sym = 0x42
+                        else:
+                            sym = 0xb5
+                        an_phase = not an_phase
+
+                enc = _enc_8b10b_table[sym]
 
                 if self.enc_8b10b:
                     # 8b/10b encode
-                    self.log.error("8b/10b decoder not yet implemented")
-                    data |= (d_val << (k*8))
-                    data_k |= (k_val << k)
+                    data |= ((enc >> 10*rd) & 0x3ff) << (k*10)
                 else:
-                    data |= (d_val << (k*8))
-                    data_k |= (k_val << k)
+                    data |= ((sym & 0xff) << (k*8))
+                    data_k |= ((sym >> 8) << k)
 
                 odd = not odd
-                rd = rd ^ rd_flip_8b10b(d_val, k_val)
+                rd = rd ^ (enc >> 20)
 
                 if rep_cnt > 0:
                     rep_cnt -= 1
-                elif self.gmii_rep_count and (odd or frame is not None):
-                    rep_cnt = self.gmii_rep_count
+                elif rep_count and (odd or frame is not None):
+                    rep_cnt = rep_count
 
             # if self.slip is not None and self.slip.value:
             #     self.bit_offset += 1
@@ -553,6 +705,9 @@ class BaseXSerdesSink:
         self.gbx_seq_gen = 0
         self.gbx_seq_len = None
         self.gbx_seq_stall = None
+        self.gbx_sched = None
+        self.gbx_sched_iter = None
+        self.gbx_gen_iter = None
         self.gbx_in_bits = 10
         self.gbx_out_bits = 10
         self.gbx_bit_cnt = 0
@@ -567,8 +722,16 @@ class BaseXSerdesSink:
         self.an_ack_match_cnt = 0
         self.an_idle_match_cnt = 0
 
+        # AN state, as events and a log of (sim time, name, value) transitions
+        self.an_cfg_event = Event()
+        self.an_ability_match_event = Event()
+        self.an_ack_match_event = Event()
+        self.an_idle_match_event = Event()
+        self.an_state = {'rx_cfg': None, 'ability_match': False, 'ack_match': False, 'idle_match': False}
+        self.an_log = []
+
         self.width = len(self.data)
-        self.byte_size = 8
+        self.byte_size = 10 if self.dec_8b10b else 8
         self.byte_lanes = self.width // self.byte_size
 
         assert self.byte_lanes in [1, 2, 4, 8]
@@ -597,6 +760,12 @@ class BaseXSerdesSink:
             self.log.info("Gearbox disabled")
             self.gbx_seq_len = None
             self.gbx_seq_stall = None
+            self.gbx_sched = None
+            return
+
+        if isinstance(seq_stall, int):
+            # stall count; stall cycles at the end of the sequence
+            seq_stall = range(seq_len-seq_stall, seq_len)
 
         seq_stall = sorted(list(set(seq_stall)))
 
@@ -623,13 +792,11 @@ class BaseXSerdesSink:
         self.gbx_seq_stall = set(seq_stall)
         self.gbx_in_bits = in_bits
         self.gbx_out_bits = out_bits
-        self.gbx_bit_cnt = 0
 
-        for k in range(self.gbx_seq_len):
-            self.gbx_bit_cnt = max(self.gbx_bit_cnt - out_bits, 0)
-            if k in self.gbx_seq_stall:
-                continue
-            self.gbx_bit_cnt += in_bits
+        self.gbx_sched = gbx_schedule(seq_len, self.gbx_seq_stall, in_bits, out_bits, rx=True)
+        self.gbx_sched_iter = cycle(self.gbx_sched)
+        self.gbx_gen_iter = cycle(self.gbx_sched)
+        self.gbx_bit_cnt = self.gbx_sched[-1][2]
 
     def set_gmii_rep_count(self, rep=0):
         self.gmii_rep_count = int(rep)
@@ -640,6 +807,7 @@ class BaseXSerdesSink:
     def get_an_cfg(self):
         an_cfg = self.an_cfg
         self.an_cfg = None
+        self.an_cfg_event.clear()
         return an_cfg
 
     def get_an_ability_match(self):
@@ -651,6 +819,58 @@ class BaseXSerdesSink:
     def get_an_idle_match(self):
         return self.an_idle_match_cnt > 2
 
+    async def _wait_an(self, event, timeout=0, timeout_unit=None):
+        if not event.is_set():
+            if timeout:
+                await First(event.wait(), Timer(timeout, timeout_unit))
+            else:
+                await event.wait()
+        return event.is_set()
+
+    async def wait_an_cfg(self, timeout=0, timeout_unit=None):
+        if await self._wait_an(self.an_cfg_event, timeout, timeout_unit):
+            return self.get_an_cfg()
+        return None
+
+    async def wait_an_ability_match(self, timeout=0, timeout_unit=None):
+        return await self._wait_an(self.an_ability_match_event, timeout, timeout_unit)
+
+    async def wait_an_ack_match(self, timeout=0, timeout_unit=None):
+        return await self._wait_an(self.an_ack_match_event, timeout, timeout_unit)
+
+    async def wait_an_idle_match(self, timeout=0, timeout_unit=None):
+        return await self._wait_an(self.an_idle_match_event, timeout, timeout_unit)
+
+    def get_an_log(self):
+        return list(self.an_log)
+
+    def clear_an_log(self):
+        self.an_log.clear()
+
+    def _an_update(self, sim_time, an_cfg=None):
+        state = self.an_state
+
+        if an_cfg is not None:
+            self.an_cfg = an_cfg
+            self.an_cfg_event.set()
+            if an_cfg != state['rx_cfg']:
+                state['rx_cfg'] = an_cfg
+                self.an_log.append((sim_time, 'rx_cfg', an_cfg))
+
+        for name, cnt, event in (
+                ('ability_match', self.an_ability_match_cnt, self.an_ability_match_event),
+                ('ack_match', self.an_ack_match_cnt, self.an_ack_match_event),
+                ('idle_match', self.an_idle_match_cnt, self.an_idle_match_event)):
+            match = cnt > 2
+            if match != state[name]:
+                state[name] = match
+                self.an_log.append((sim_time, name, match))
+                self.log.info("AN %s: %s", name.replace('_', ' '), match)
+                if match:
+                    event.set()
+                else:
+                    event.clear()
+
     def _recv(self, frame, compact=True):
         if self.queue.empty():
             self.active_event.clear()
@@ -729,28 +949,27 @@ class BaseXSerdesSink:
             # gearbox sequence
             if self.gbx_seq_len:
                 # generation
-                self.gbx_seq_gen = (self.gbx_seq_gen + 1) % self.gbx_seq_len
+                self.gbx_seq_gen, stall, bit_cnt = next(self.gbx_gen_iter)
 
                 if self.gbx_req_sync is not None:
                     self.gbx_req_sync.value = (self.gbx_seq_gen == 0)
 
                 # stall cycle
                 if self.gbx_req_stall is not None:
-                    self.gbx_req_stall.value = (self.gbx_seq_gen in self.gbx_seq_stall)
+                    self.gbx_req_stall.value = stall
 
                 # sync
-                self.gbx_seq = (self.gbx_seq + 1) % self.gbx_seq_len
+                self.gbx_seq, stall, self.gbx_bit_cnt = next(self.gbx_sched_iter)
 
                 if self.gbx_sync is not None:
-                    if int(self.gbx_sync.value):
-                        self.gbx_seq = 0
-
-                self.gbx_bit_cnt = max(self.gbx_bit_cnt - self.gbx_out_bits, 0)
+                    if self.gbx_seq and int(self.gbx_sync.value):
+                        # restart sequence
+                        self.gbx_sched_iter = cycle(self.gbx_sched)
+                        self.gbx_seq, stall, self.gbx_bit_cnt = self.gbx_sched[-1]
 
-                if self.gbx_seq in self.gbx_seq_stall:
+                if stall:
                     continue
 
-                self.gbx_bit_cnt += self.gbx_in_bits
                 gbx_delay = (self.gbx_bit_cnt * clk_period) // self.gbx_out_bits
             else:
                 self.gbx_seq = 0
@@ -787,9 +1006,18 @@ class BaseXSerdesSink:
             for k in range(self.byte_lanes):
                 if self.dec_8b10b:
                     # 8b/10b decode
-                    self.log.error("8b/10b decoder not yet implemented")
-                    d_val = (data >> (k*8)) & 0xff
-                    k_val = bool((data_k >> k) & 0x1)
+                    dec = _dec_8b10b_table[(data >> (k*10)) & 0x3ff]
+                    if (dec >> (9+rd)) & 1:
+                        d_val = dec & 0xff
+                        k_val = bool(dec & _DEC_8B10B_K)
+                    else:
+                        if dec & _DEC_8B10B_CV:
+                            self.log.warning("8b/10b code violation: 0x%03x", (data >> (k*10)) & 0x3ff)
+                        else:
+                            self.log.warning("8b/10b disparity error: 0x%03x", (data >> (k*10)) & 0x3ff)
+                        d_val = XgmiiCtrl.ERROR
+                        k_val = True
+                    rd = (dec >> (11+rd)) & 1
                 else:
                     d_val = (data >> (k*8)) & 0xff
                     k_val = bool((data_k >> k) & 0x1)
@@ -797,6 +1025,7 @@ class BaseXSerdesSink:
                 # 1000BASE-X decoding
 
                 an_cnt_reset = True
+                an_update = False
 
                 if frame is not None:
                     # in a frame
@@ -831,7 +1060,9 @@ class BaseXSerdesSink:
                 elif an_cfg is not None:
                     # config register
                     an_cnt_reset = False
-                    self.an_idle_match_cnt = 0
+                    if self.an_idle_match_cnt:
+                        self.an_idle_match_cnt = 0
+                        an_update = True
 
                     if k_val:
                         # got a control character; abort
@@ -851,7 +1082,7 @@ class BaseXSerdesSink:
                             else:
                                 self.an_ack_match_cnt = 0
                             last_an_cfg = an_cfg
-                            self.an_cfg = an_cfg
+                            self._an_update(sim_time + (clk_period // self.byte_lanes * k) + gbx_delay, an_cfg)
                             an_cfg = None
                 else:
                     # idle
@@ -891,18 +1122,26 @@ class BaseXSerdesSink:
                         else:
                             # idle
                             an_cnt_reset = False
+                            if self.an_ability_match_cnt or self.an_ack_match_cnt:
+                                an_update = True
                             self.an_ability_match_cnt = 0
                             self.an_ack_match_cnt = 0
                             self.an_idle_match_cnt += 1
+                            if self.an_idle_match_cnt == 3:
+                                an_update = True
 
                 if skip_cnt > 0:
                     skip_cnt -= 1
                 elif self.gmii_rep_count:
                     skip_cnt = self.gmii_rep_count
 
-                if an_cnt_reset:
+                if an_cnt_reset and (self.an_ability_match_cnt or self.an_ack_match_cnt or self.an_idle_match_cnt):
                     self.an_ability_match_cnt = 0
                     self.an_ack_match_cnt = 0
                     self.an_idle_match_cnt = 0
+                    an_update = True
+
+                if an_update:
+                    self._an_update(sim_time + (clk_period // self.byte_lanes * k) + gbx_delay)
 
                 odd = not odd
@@ -22,7 +22,7 @@ import cocotb_test.simulator
 
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, Timer
+from cocotb.triggers import RisingEdge, Timer, First
 from cocotb.utils import get_time_from_sim_steps
 
 from cocotbext.eth import GmiiFrame, PtpClockSimTime
@@ -833,8 +833,6 @@ async def run_basex_an(tb, port=0, cfg=0x0020, sgmii=False):
     if sgmii:
         link_timer = Timer(1.6, 'us')
 
-    dut = tb.dut
-
     for k in range(10):
         tb.log.info("AN_RESTART")
         tb.serdes_sources[port].set_an_cfg(0x0000)
@@ -847,9 +845,9 @@ async def run_basex_an(tb, port=0, cfg=0x0020, sgmii=False):
 
         lp_cfg = None
         while True:
-            await RisingEdge(dut.tx_clk[port])
-            lp_cfg = tb.serdes_sinks[port].get_an_cfg()
-            if tb.serdes_sinks[port].get_an_ability_match() and lp_cfg is not None and lp_cfg != 0:
+            await tb.serdes_sinks[port].wait_an_ability_match()
+            lp_cfg = await tb.serdes_sinks[port].wait_an_cfg()
+            if tb.serdes_sinks[port].get_an_ability_match() and lp_cfg != 0:
                 break
 
         tb.log.info("ACKNOWLEDGE_DETECT")
@@ -858,11 +856,11 @@ async def run_basex_an(tb, port=0, cfg=0x0020, sgmii=False):
 
         lp_cfg_ack = None
         while True:
-            await RisingEdge(dut.tx_clk[port])
-            lp_cfg_ack = tb.serdes_sinks[port].get_an_cfg()
+            await tb.serdes_sinks[port].wait_an_ability_match()
+            lp_cfg_ack = await tb.serdes_sinks[port].wait_an_cfg()
             if tb.serdes_sinks[port].get_an_ack_match() and lp_cfg_ack:
                 break
-            elif tb.serdes_sinks[port].get_an_ability_match() and lp_cfg_ack is not None and lp_cfg_ack == 0:
+            elif tb.serdes_sinks[port].get_an_ability_match() and lp_cfg_ack == 0:
                 break
 
         if lp_cfg | 0x4000 != lp_cfg_ack:
@@ -882,7 +880,7 @@ async def run_basex_an(tb, port=0, cfg=0x0020, sgmii=False):
         await link_timer
 
         while True:
-            await RisingEdge(dut.tx_clk[port])
+            await First(tb.serdes_sinks[port].an_idle_match_event.wait(), tb.serdes_sinks[port].an_cfg_event.wait())
             lp_cfg_ack2 = tb.serdes_sinks[port].get_an_cfg()
             if tb.serdes_sinks[port].get_an_idle_match():
                 break
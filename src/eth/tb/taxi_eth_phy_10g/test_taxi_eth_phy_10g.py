@@ -173,6 +173,33 @@ async def run_test_tx(dut, payload_lengths=None, payload_data=None, ifg=12):
     await RisingEdge(dut.tx_clk)
 
 
+@cocotb.test()
+async def run_test_tx_rx_arena(dut):
+
+    tb = TB(dut)
+
+    # small arena so that it wraps during the test
+    tb.serdes_sink.set_rx_arena(4096)
+
+    await tb.reset()
+
+    test_frames = [XgmiiFrame.from_payload(incrementing_payload(x)) for x in size_list()]
+
+    for test_frame in test_frames:
+        await tb.xgmii_source.send(XgmiiFrame(test_frame))
+
+    for test_frame in test_frames:
+        rx_frame = await tb.serdes_sink.recv()
+
+        assert rx_frame == test_frame
+        assert rx_frame.check_fcs()
+
+    assert tb.serdes_sink.empty()
+
+    await RisingEdge(dut.tx_clk)
+    await RisingEdge(dut.tx_clk)
+
+
 @cocotb.test()
 async def run_test_rx_frame_sync(dut):
 
@@ -19,7 +19,7 @@ import cocotb_test.simulator
 import pytest
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge, Timer
+from cocotb.triggers import RisingEdge, Timer, First
 
 from cocotbext.eth import GmiiSource, GmiiSink, GmiiFrame
 
@@ -195,8 +195,6 @@ async def run_basex_an(tb, cfg, sgmii=False):
     if sgmii:
         link_timer = Timer(1.6, 'us')
 
-    dut = tb.dut
-
     for k in range(10):
         tb.log.info("AN_RESTART")
         tb.serdes_source.set_an_cfg(0x0000)
@@ -209,9 +207,9 @@ async def run_basex_an(tb, cfg, sgmii=False):
 
         lp_cfg = None
         while True:
-            await RisingEdge(dut.tx_clk)
-            lp_cfg = tb.serdes_sink.get_an_cfg()
-            if tb.serdes_sink.get_an_ability_match() and lp_cfg is not None and lp_cfg != 0:
+            await tb.serdes_sink.wait_an_ability_match()
+            lp_cfg = await tb.serdes_sink.wait_an_cfg()
+            if tb.serdes_sink.get_an_ability_match() and lp_cfg != 0:
                 break
 
         tb.log.info("ACKNOWLEDGE_DETECT")
@@ -220,11 +218,11 @@ async def run_basex_an(tb, cfg, sgmii=False):
 
         lp_cfg_ack = None
         while True:
-            await RisingEdge(dut.tx_clk)
-            lp_cfg_ack = tb.serdes_sink.get_an_cfg()
-            if tb.serdes_sink.get_an_ack_match() and lp_cfg_ack is not None:
+            await tb.serdes_sink.wait_an_ability_match()
+            lp_cfg_ack = await tb.serdes_sink.wait_an_cfg()
+            if tb.serdes_sink.get_an_ack_match():
                 break
-            elif tb.serdes_sink.get_an_ability_match() and lp_cfg_ack is not None and lp_cfg_ack == 0:
+            elif tb.serdes_sink.get_an_ability_match() and lp_cfg_ack == 0:
                 break
 
         if lp_cfg | 0x4000 != lp_cfg_ack:
@@ -244,7 +242,7 @@ async def run_basex_an(tb, cfg, sgmii=False):
         await link_timer
 
         while True:
-            await RisingEdge(dut.tx_clk)
+            await First(tb.serdes_sink.an_idle_match_event.wait(), tb.serdes_sink.an_cfg_event.wait())
             lp_cfg_ack2 = tb.serdes_sink.get_an_cfg()
             if tb.serdes_sink.get_an_idle_match():
                 break
@@ -12,10 +12,14 @@ Authors:
 import logging
 import mmap
 import struct
+import sys
+from array import array
+from collections import deque
 
 import cocotb
 from cocotb.queue import Queue, QueueFull
 from cocotb.triggers import RisingEdge, Timer, First, Event
+from cocotb.utils import get_sim_time
 from cocotb_bus.bus import Bus
 
 from cocotbext.pcie.core import Device
@@ -88,14 +92,55 @@ def parity(d):
     return p
 
 
+# byte parity lookup tables (even and odd)
+_byte_parity = bytes(bin(x).count('1') & 1 for x in range(256))
+_byte_parity_odd = bytes(p ^ 1 for p in _byte_parity)
+
+
+def bulk_dword_parity(data, odd=False):
+    # per-dword parity of a little-endian byte string, one bit per byte
+    # (same as dword_parity for each dword, or its complement if odd is set)
+    p = int.from_bytes(data.translate(_byte_parity_odd if odd else _byte_parity), 'little')
+    # fold the parity bits of bytes 1-3 into bits 1-3 of byte 0
+    p = p | p >> 7 | p >> 14 | p >> 21
+    return p.to_bytes(len(data), 'little')[::4]
+
+
+# nibble <-> hex digit lookup tables, for packing and unpacking per-dword parity
+_nibble_hex = bytes(b'0123456789abcdef'[x & 0xf] for x in range(256))
+_hex_nibble = bytes(int(chr(x), 16) if chr(x) in '0123456789abcdef' else 0 for x in range(256))
+
+
+def dwords_from_bytes(data):
+    # dword array from a little-endian byte string
+    dw = array('I', data)
+    if sys.byteorder != 'little':
+        dw.byteswap()
+    return dw
+
+
+def dwords_to_bytes(dw):
+    # little-endian byte string from a dword array (or list)
+    if sys.byteorder != 'little' or not isinstance(dw, array):
+        return struct.pack(f'<{len(dw)}L', *dw)
+    return dw.tobytes()
+
+
+def dwords_equal(a, b):
+    # compare dword sequences; an array never compares equal to a list
+    if type(a) is type(b):
+        return a == b
+    return len(a) == len(b) and all(x == y for x, y in zip(a, b))
+
+
 class PcieIfFrame:
     def __init__(self, frame=None):
         self.tlp_prfx = 0
         self.hdr = 0
-        self.data = []
+        self.data = array('I')
         self.tlp_prfx_par = 0
         self.hdr_par = 0
-        self.parity = []
+        self._parity = bytearray()
         self.func_num = 0
         self.vf_num = None
         self.bar_id = 0
@@ -106,10 +151,13 @@ class PcieIfFrame:
         if isinstance(frame, PcieIfFrame):
             self.tlp_prfx = frame.tlp_prfx
             self.hdr = frame.hdr
-            self.data = list(frame.data)
+            self.data = array('I', frame.data)
             self.tlp_prfx_par = frame.tlp_prfx_par
             self.hdr_par = frame.hdr_par
-            self.parity = list(frame.parity)
+            if frame._parity is not None:
+                self._parity = bytearray(frame._parity)
+            else:
+                self._parity = None
             self.func_num = frame.func_num
             self.vf_num = frame.vf_num
             self.bar_id = frame.bar_id
@@ -132,11 +180,12 @@ class PcieIfFrame:
 
         frame.hdr = int.from_bytes(hdr.ljust(16, b'\x00'), 'big')
 
-        data = tlp.get_data()
-        for k in range(0, len(data), 4):
-            frame.data.extend(struct.unpack_from('<L', data, k))
+        frame.data = dwords_from_bytes(tlp.get_data())
 
-        frame.update_parity()
+        # data parity is computed on first use
+        frame._parity = None
+        frame.hdr_par = parity(frame.hdr)
+        frame.tlp_prfx_par = dword_parity(frame.tlp_prfx)
 
         return frame
 
@@ -149,19 +198,31 @@ class PcieIfFrame:
 
         tlp = Tlp.unpack_header(hdr)
 
-        for dw in self.data:
-            tlp.data.extend(struct.pack('<L', dw))
+        tlp.data.extend(dwords_to_bytes(self.data))
 
         return tlp
 
+    @property
+    def parity(self):
+        if self._parity is None:
+            self._parity = self._data_parity()
+        return self._parity
+
+    @parity.setter
+    def parity(self, value):
+        self._parity = value
+
+    def _data_parity(self):
+        return bytearray(bulk_dword_parity(dwords_to_bytes(self.data), odd=True))
+
     def update_parity(self):
-        self.parity = [dword_parity(d) ^ 0xf for d in self.data]
+        self._parity = self._data_parity()
         self.hdr_par = parity(self.hdr)
         self.tlp_prfx_par = dword_parity(self.tlp_prfx)
 
     def check_parity(self):
         return (
-            self.parity == [dword_parity(d) ^ 0xf for d in self.data] and
+            self.parity == self._data_parity() and
             self.hdr_par == parity(self.hdr) and
             self.tlp_prfx_par == dword_parity(self.tlp_prfx)
         )
@@ -171,10 +232,10 @@ class PcieIfFrame:
             return (
                 self.tlp_prfx == other.tlp_prfx and
                 self.hdr == other.hdr and
-                self.data == other.data and
+                dwords_equal(self.data, other.data) and
                 self.tlp_prfx_par == other.tlp_prfx_par and
                 self.hdr_par == other.hdr_par and
-                self.parity == other.parity and
+                ((self._parity is None and other._parity is None) or self.parity == other.parity) and
                 self.func_num == other.func_num and
                 self.vf_num == other.vf_num and
                 self.bar_id == other.bar_id and
@@ -189,7 +250,7 @@ class PcieIfFrame:
             f"{type(self).__name__}(tlp_prfx={self.tlp_prfx:#010x}, hdr={self.hdr:#034x}, "
             f"data=[{', '.join(f'{x:#010x}' for x in self.data)}], "
             f"tlp_prfx_par={self.tlp_prfx_par:#x}, hdr_par={self.hdr_par:#06x}, "
-            f"parity=[{', '.join(hex(x) for x in self.parity)}], "
+            f"parity={self._parity_repr()}, "
             f"func_num={self.func_num}, "
             f"vf_num={self.vf_num}, "
             f"bar_id={self.bar_id}, "
@@ -198,6 +259,12 @@ class PcieIfFrame:
             f"seq={self.seq})"
         )
 
+    def _parity_repr(self):
+        # don't compute lazy parity just to print it
+        if self._parity is None:
+            return "<lazy>"
+        return f"[{', '.join(hex(x) for x in self._parity)}]"
+
     def __len__(self):
         return len(self.data)
 
@@ -221,6 +288,114 @@ class PcieIfTransaction:
         return f"{type(self).__name__}({', '.join(f'{s}={int(getattr(self, s))}' for s in self._signals)})"
 
 
+class PcieIfFlowControl:
+    # PCIe flow control credit accounting for one direction of an interface
+    # credit order: ph, pd, nph, npd, cplh, cpld; a limit of 0 is infinite
+    # credits are returned latency clock cycles after release (0: immediately)
+
+    def __init__(self, clock, ph=0, pd=0, nph=0, npd=0, cplh=0, cpld=0, latency=0,
+            ph_av=None, pd_av=None, nph_av=None, npd_av=None, cplh_av=None, cpld_av=None):
+        self.clock = clock
+
+        self.limit = [ph, pd, nph, npd, cplh, cpld]
+        self.consumed = [0]*6
+        self.latency = latency
+
+        self.av_signals = [init_signal(sig, None, 0) for sig in [ph_av, pd_av, nph_av, npd_av, cplh_av, cpld_av]]
+
+        self.log = logging.getLogger("cocotb.pcie_if")
+
+        self.cycle = 0
+        self.returns = deque()
+        self.update_event = Event()
+
+        self._run_cr = cocotb.start_soon(self._run())
+
+    @staticmethod
+    def frame_credits(frame):
+        # credit index (ph, nph, or cplh) and data credits for a frame
+        fmt_type = (frame.hdr >> 120) & 0xff
+        if (fmt_type & 0xdf) == 0x40 or (fmt_type & 0x38) == 0x30:
+            # posted: memory write, message
+            idx = 0
+        elif (fmt_type & 0xbe) == 0x0a:
+            # completion
+            idx = 4
+        else:
+            # non-posted
+            idx = 2
+        if frame.hdr & (1 << 126):
+            return idx, (len(frame.data)+3) // 4
+        return idx, 0
+
+    def available(self, idx):
+        if not self.limit[idx]:
+            return None
+        return self.limit[idx] - self.consumed[idx]
+
+    def check(self, frame):
+        idx, dc = self.frame_credits(frame)
+        if self.limit[idx] and self.consumed[idx] >= self.limit[idx]:
+            return False
+        if dc and self.limit[idx+1] and self.consumed[idx+1] + dc > self.limit[idx+1]:
+            if self.consumed[idx+1] or dc <= self.limit[idx+1]:
+                return False
+            # can never fit; let it through on an empty pool
+            self.log.warning("TLP needs %d data credits, more than the pool of %d", dc, self.limit[idx+1])
+        return True
+
+    def exhausted(self, pending=0):
+        # true if any limited pool has no credits available, counting
+        # pending (received but not yet consumed) TLPs against header credits
+        for idx in range(6):
+            if self.limit[idx] and self.consumed[idx] + (0 if idx & 1 else pending) >= self.limit[idx]:
+                return True
+        return False
+
+    def consume(self, frame):
+        idx, dc = self.frame_credits(frame)
+        self.consumed[idx] += 1
+        self.consumed[idx+1] += dc
+
+    def release(self, frame):
+        idx, dc = self.frame_credits(frame)
+        if not self.latency:
+            self.consumed[idx] -= 1
+            self.consumed[idx+1] -= dc
+            self.update_event.set()
+            return
+        self.returns.append((self.cycle + self.latency, idx, dc))
+
+    async def acquire(self, frame):
+        while not self.check(frame):
+            self.update_event.clear()
+            await self.update_event.wait()
+        self.consume(frame)
+
+    async def _run(self):
+        clock_edge_event = RisingEdge(self.clock)
+
+        while True:
+            await clock_edge_event
+
+            self.cycle += 1
+
+            if self.returns and self.returns[0][0] <= self.cycle:
+                while self.returns and self.returns[0][0] <= self.cycle:
+                    cycle, idx, dc = self.returns.popleft()
+                    self.consumed[idx] -= 1
+                    self.consumed[idx+1] -= dc
+                self.update_event.set()
+
+            for idx, sig in enumerate(self.av_signals):
+                if sig is not None:
+                    mask = 2**len(sig)-1
+                    if self.limit[idx]:
+                        sig.value = min(max(self.limit[idx] - self.consumed[idx], 0), mask)
+                    else:
+                        sig.value = mask
+
+
 class PcieIfBase:
 
     _signal_widths = {"ready": 1}
@@ -248,8 +423,12 @@ class PcieIfBase:
 
         self.pause = False
         self._pause_generator = None
+        self._pause_pattern = None
+        self._pause_index = 0
         self._pause_cr = None
 
+        self.fc = None
+
         self.queue_occupancy_bytes = 0
         self.queue_occupancy_frames = 0
 
@@ -308,7 +487,9 @@ class PcieIfBase:
             self.vf_num_width = 11
         self.vf_num_mask = 2**self.vf_num_width-1
 
-        if hasattr(self.bus, "data_par"):
+        self.data_par_present = hasattr(self.bus, "data_par")
+
+        if self.data_par_present:
             assert len(self.bus.data_par) == self.seg_count*self.seg_width//8
         if hasattr(self.bus, "hdr_par"):
             assert len(self.bus.hdr_par) == self.seg_count*128//8
@@ -338,14 +519,38 @@ class PcieIfBase:
             self._pause_cr.kill()
             self._pause_cr = None
 
-        self._pause_generator = generator
-
-        if self._pause_generator is not None:
+        self._pause_generator = None
+        self._pause_pattern = None
+
+        if callable(generator):
+            generator = generator()
+
+        if isinstance(generator, (list, tuple, bytes, bytearray, array)):
+            # precomputed cyclic pattern, evaluated in the main clock loop
+            if generator:
+                self._pause_pattern = [bool(x) for x in generator]
+                self._pause_index = 0
+                self.pause = self._pause_pattern[0]
+        elif generator is not None:
+            self._pause_generator = generator
             self._pause_cr = cocotb.start_soon(self._run_pause())
 
     def clear_pause_generator(self):
         self.set_pause_generator(None)
 
+    def _step_pause(self):
+        # advance a precomputed pause pattern, called once per clock
+        if self._pause_pattern is not None:
+            self._pause_index += 1
+            if self._pause_index >= len(self._pause_pattern):
+                self._pause_index = 0
+            self.pause = self._pause_pattern[self._pause_index]
+
+    def set_flow_control(self, fc=None):
+        self.fc = fc
+        if fc is not None:
+            fc.log = self.log
+
     async def _run_pause(self):
         clock_edge_event = RisingEdge(self.clock)
 
@@ -422,15 +627,15 @@ class PcieIfSource(PcieIfBase):
         while self.full():
             self.dequeue_event.clear()
             await self.dequeue_event.wait()
-        frame = PcieIfFrame(frame)
-        await self.queue.put(frame)
-        self.idle_event.clear()
-        self.queue_occupancy_bytes += len(frame)
-        self.queue_occupancy_frames += 1
+        self._enqueue(frame)
 
     def send_nowait(self, frame):
         if self.full():
             raise QueueFull()
+        self._enqueue(frame)
+
+    def _enqueue(self, frame):
+        # queue a frame, ignoring the occupancy limits
         frame = PcieIfFrame(frame)
         self.queue.put_nowait(frame)
         self.idle_event.clear()
@@ -459,6 +664,8 @@ class PcieIfSource(PcieIfBase):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             # read handshake signals
             ready_sample = self.bus.ready.value
             valid_sample = self.bus.valid.value
@@ -481,10 +688,18 @@ class PcieIfSource(PcieIfBase):
                         self.idle_event.set()
 
     async def _run(self):
+        next_frame = None
+
         while True:
-            frame = await self._get_frame()
+            if next_frame is not None:
+                frame = next_frame
+                next_frame = None
+            else:
+                frame = await self._get_frame()
+            if self.fc is not None:
+                await self.fc.acquire(frame)
             frame_offset = 0
-            self.log.info(f"TX frame: {frame}")
+            self.log.info("TX frame: %s", frame)
             first = True
 
             while frame is not None:
@@ -492,10 +707,17 @@ class PcieIfSource(PcieIfBase):
 
                 for seg in range(self.seg_count):
                     if frame is None:
-                        if not self.empty():
+                        if next_frame is None and not self.empty():
                             frame = self._get_frame_nowait()
+                            if self.fc is not None:
+                                if not self.fc.check(frame):
+                                    # out of credits; send in a later beat
+                                    next_frame = frame
+                                    frame = None
+                                    break
+                                self.fc.consume(frame)
                             frame_offset = 0
-                            self.log.info(f"TX frame: {frame}")
+                            self.log.info("TX frame: %s", frame)
                             first = True
                         else:
                             break
@@ -523,14 +745,19 @@ class PcieIfSource(PcieIfBase):
 
                         cnt = min(self.seg_byte_lanes, len(frame.data)-frame_offset)
                         transaction.empty |= (self.seg_byte_lanes-cnt) << (seg*self.seg_empty_width)
-                        for k in range(cnt):
-                            transaction.data |= frame.data[frame_offset] << 32*(k+seg*self.seg_byte_lanes)
-                            transaction.data_par |= frame.parity[frame_offset] << 4*(k+seg*self.seg_byte_lanes)
-                            frame_offset += 1
+                        seg_data = dwords_to_bytes(frame.data[frame_offset:frame_offset+cnt])
+                        transaction.data |= int.from_bytes(seg_data, 'little') << seg*self.seg_width
+                        if self.data_par_present:
+                            seg_par = bytes(frame.parity[frame_offset:frame_offset+cnt])
+                            transaction.data_par |= int(seg_par.translate(_nibble_hex)[::-1], 16) << seg*self.seg_par_width
+                        frame_offset += cnt
 
                     if frame_offset >= len(frame.data):
                         transaction.eop |= 1 << seg
 
+                        if self.fc is not None:
+                            self.fc.release(frame)
+
                         frame = None
 
                 await self._drive(transaction)
@@ -581,6 +808,8 @@ class PcieIfSink(PcieIfBase):
             self.active_event.clear()
         self.queue_occupancy_bytes -= len(frame)
         self.queue_occupancy_frames -= 1
+        if self.fc is not None:
+            self.fc.release(frame)
         return frame
 
     async def recv(self):
@@ -602,6 +831,14 @@ class PcieIfSink(PcieIfBase):
     def idle(self):
         return not self.active
 
+    def clear(self):
+        while not self.queue.empty():
+            frame = self.queue.get_nowait()
+            if self.fc is not None:
+                self.fc.release(frame)
+        self.idle_event.set()
+        self.active_event.clear()
+
     async def wait(self, timeout=0, timeout_unit='ns'):
         if not self.empty():
             return
@@ -616,6 +853,8 @@ class PcieIfSink(PcieIfBase):
         while True:
             await clock_edge_event
 
+            self._step_pause()
+
             # read handshake signals
             ready_sample = self.bus.ready.value
             valid_sample = self.bus.valid.value
@@ -624,12 +863,18 @@ class PcieIfSink(PcieIfBase):
                 self.bus.ready.value = 0
                 continue
 
+            pending = 0
+
             if ready_sample and valid_sample:
                 self.sample_obj = self._transaction_obj()
                 self.bus.sample(self.sample_obj)
                 self.sample_sync.set()
+                if self.fc is not None:
+                    pending = bin(int(valid_sample) & int(self.bus.eop.value)).count('1')
 
-            self.bus.ready.value = (not self.full() and not self.pause)
+            # hold off while out of credits, for DUTs that don't use the *_av signals
+            self.bus.ready.value = (not self.full() and not self.pause and
+                (self.fc is None or not self.fc.exhausted(pending)))
 
     async def _run(self):
         self.active = False
@@ -645,18 +890,37 @@ class PcieIfSink(PcieIfBase):
             sample = self.sample_obj
             self.sample_obj = None
 
+            # convert each signal once per beat
+            valid = int(sample.valid)
+            sop = int(sample.sop)
+            eop = int(sample.eop)
+
+            if sop:
+                tlp_prfx = int(sample.tlp_prfx)
+                tlp_prfx_par = int(sample.tlp_prfx_par)
+                hdr = int(sample.hdr)
+                hdr_par = int(sample.hdr_par)
+                bar_id = int(sample.bar_id)
+                func_num = int(sample.func_num)
+                vf_active = int(sample.vf_active)
+                error = int(sample.error)
+                seq = int(sample.seq)
+
+            data = None
+            data_par = None
+
             for seg in range(self.seg_count):
-                if not int(sample.valid) & (1 << seg):
+                if not valid & (1 << seg):
                     continue
 
-                if int(sample.sop) & (1 << seg):
+                if sop & (1 << seg):
                     assert frame is None, "framing error: sop asserted in frame"
                     frame = PcieIfFrame()
 
-                    frame.tlp_prfx = (int(sample.tlp_prfx) >> (seg*32)) & 0xffffffff
-                    frame.tlp_prfx_par = (int(sample.tlp_prfx_par) >> (seg*4)) & 0xf
-                    frame.hdr = (int(sample.hdr) >> (seg*128)) & (2**128-1)
-                    frame.hdr_par = (int(sample.hdr_par) >> (seg*16)) & 0xffff
+                    frame.tlp_prfx = (tlp_prfx >> (seg*32)) & 0xffffffff
+                    frame.tlp_prfx_par = (tlp_prfx_par >> (seg*4)) & 0xf
+                    frame.hdr = (hdr >> (seg*128)) & (2**128-1)
+                    frame.hdr_par = (hdr_par >> (seg*16)) & 0xffff
                     if frame.hdr & (1 << 126):
                         dword_count = (frame.hdr >> 96) & 0x3ff
                         if dword_count == 0:
@@ -664,33 +928,43 @@ class PcieIfSink(PcieIfBase):
                     else:
                         dword_count = 0
 
-                    frame.bar_id = (int(sample.bar_id) >> seg*3) & 0x7
-                    frame.func_num = (int(sample.func_num) >> seg*self.func_num_width) & self.func_num_mask
-                    if int(sample.vf_active) & (1 << seg):
+                    frame.bar_id = (bar_id >> seg*3) & 0x7
+                    frame.func_num = (func_num >> seg*self.func_num_width) & self.func_num_mask
+                    if vf_active & (1 << seg):
                         frame.vf_num = (int(sample.vf_num) >> seg*self.vf_num_width) & self.vf_num_mask
-                    frame.error = (int(sample.error) >> seg*4) & 0xf
-                    frame.seq = (int(sample.seq) >> seg*self.seq_width) & self.seq_mask
+                    frame.error = (error >> seg*4) & 0xf
+                    frame.seq = (seq >> seg*self.seq_width) & self.seq_mask
 
                 assert frame is not None, "framing error: data transferred outside of frame"
 
                 if dword_count > 0:
-                    data = (int(sample.data) >> (seg*self.seg_width)) & self.seg_mask
-                    data_par = (int(sample.data_par) >> (seg*self.seg_par_width)) & self.seg_par_mask
-                    empty = (int(sample.empty) >> (seg*self.seg_empty_width)) & self.seg_empty_mask
-                    for k in range(self.seg_byte_lanes):
-                        if dword_count > 0:
-                            frame.data.append((data >> 32*k) & 0xffffffff)
-                            frame.parity.append((data_par >> 4*k) & 0xf)
-                            dword_count -= 1
-
-                if int(sample.eop) & (1 << seg):
+                    if data is None:
+                        data = int(sample.data).to_bytes(self.width//8, 'little')
+                        if self.data_par_present:
+                            data_par = f"{int(sample.data_par):0{self.width//32}x}"[::-1].encode().translate(_hex_nibble)
+
+                    cnt = min(self.seg_byte_lanes, dword_count)
+                    offset = seg*self.seg_byte_lanes
+                    frame.data.extend(dwords_from_bytes(data[offset*4:(offset+cnt)*4]))
+                    if self.data_par_present:
+                        frame.parity.extend(data_par[offset:offset+cnt])
+                    else:
+                        frame.parity.extend(bytes(cnt))
+                    dword_count -= cnt
+
+                if eop & (1 << seg):
                     assert dword_count == 0, "framing error: incorrect length or early eop"
-                    self.log.info(f"RX frame: {frame}")
+                    self.log.info("RX frame: %s", frame)
                     self._sink_frame(frame)
                     self.active = False
                     frame = None
 
     def _sink_frame(self, frame):
+        if self.fc is not None:
+            if not self.fc.check(frame):
+                self.log.warning("Flow control credit overflow: %s", frame)
+            self.fc.consume(frame)
+
         self.queue_occupancy_bytes += len(frame)
         self.queue_occupancy_frames += 1
 
@@ -1339,14 +1613,30 @@ class PcieIfTestDevice:
 
         self.bar_ptr = 0
         self.regions = [None]*6
+        self.region_mem = [None]*6
+
+        # completion split plans, keyed by (addr & 0x7f, dw_length, byte_length, max_payload)
+        self.cpl_plans = {}
 
-        self.current_tag = 0
-        self.tag_count = 32
         self.tag_active = [False]*256
-        self.tag_release = Event()
+        self.tag_free = deque()
+        self.tag_free_count = 0
+        self.tag_waiters = deque()
+        self.tag_count = 32
+
+        # outstanding non-posted requests by tag: (request, completions, done event)
+        self.tag_ops = [None]*256
 
-        self.rx_cpl_queues = [Queue() for k in range(256)]
-        self.rx_cpl_sync = [Event() for k in range(256)]
+        # posted credit window for dma_mem_write: header credits (TLPs) and
+        # data credits (16 bytes) held by the receiver, 0 for unlimited.
+        # Credits are consumed as TLPs are transmitted and returned
+        # posted_credit_latency cycles after the last beat, via flow control
+        # on tx_wr_req_tlp_source.  Memory writes are queued up to the window
+        # regardless of the source frame limit, which still applies to IO
+        # writes.
+        self.posted_ph_window = 0
+        self.posted_pd_window = 0
+        self.posted_credit_latency = 0
 
         self.dev_max_payload = 0
         self.dev_max_read_req = 0
@@ -1406,8 +1696,10 @@ class PcieIfTestDevice:
 
         # fork coroutines
 
-        cocotb.start_soon(self._run_rx_req_tlp())
-        cocotb.start_soon(self._run_rx_cpl_tlp())
+        if self.rx_req_tlp_sink is not None:
+            cocotb.start_soon(self._run_rx_req_tlp())
+        if self.rx_cpl_tlp_sink is not None:
+            cocotb.start_soon(self._run_rx_cpl_tlp())
 
     def add_region(self, size, read=None, write=None, ext=False, prefetch=False, io=False):
         if self.bar_ptr > 5 or (ext and self.bar_ptr > 4):
@@ -1417,6 +1709,7 @@ class PcieIfTestDevice:
         if not read and not write:
             mem = mmap.mmap(-1, size)
             self.regions[self.bar_ptr] = (size, mem)
+            self.region_mem[self.bar_ptr] = memoryview(mem)
         else:
             self.regions[self.bar_ptr] = (size, read, write)
         if ext:
@@ -1435,95 +1728,167 @@ class PcieIfTestDevice:
         return self.add_region(size, read, write, True, True)
 
     async def read_region(self, region, addr, length):
+        mem = self.region_mem[region]
+        if mem is not None:
+            return bytes(mem[addr:addr+length])
         if not self.regions[region]:
             raise Exception("Invalid region")
-        if len(self.regions[region]) == 3:
-            return await self.regions[region][1](addr, length)
-        else:
-            return self.regions[region][1][addr:addr+length]
+        return await self.regions[region][1](addr, length)
 
     async def write_region(self, region, addr, data):
+        mem = self.region_mem[region]
+        if mem is not None:
+            mem[addr:addr+len(data)] = data
+            return
         if not self.regions[region]:
             raise Exception("Invalid region")
-        if len(self.regions[region]) == 3:
-            await self.regions[region][2](addr, data)
-        else:
-            self.regions[region][1][addr:addr+len(data)] = data
+        await self.regions[region][2](addr, data)
+
+    def _get_cpl_plan(self, addr, dw_length, byte_length):
+        # split a read completion on max payload size and RCB boundaries
+        # returns (dword offset, dword length, byte count, lower address) per completion
+        key = (addr & 0x7f, dw_length, byte_length, self.dev_max_payload)
+        plan = self.cpl_plans.get(key)
+        if plan is not None:
+            return plan
+
+        max_dw = 32 << self.dev_max_payload
+        addr &= 0x7f
+        plan = []
+        m = 0
+        n = 0
 
-    async def recv_cpl(self, tag, timeout=0, timeout_unit='ns'):
-        queue = self.rx_cpl_queues[tag]
-        sync = self.rx_cpl_sync[tag]
+        while m < dw_length:
+            cpl_dw_length = dw_length - m
+            if cpl_dw_length > max_dw:
+                # max payload size
+                cpl_dw_length = max_dw
+                # RCB align
+                cpl_dw_length -= (addr & 0x7c) >> 2
 
-        if not queue.empty():
-            return queue.get_nowait()
+            plan.append((m, cpl_dw_length, byte_length - n, addr & 0x7f))
 
-        sync.clear()
-        if timeout:
-            await First(sync.wait(), Timer(timeout, timeout_unit))
-        else:
-            await sync.wait()
+            m += cpl_dw_length
+            n += cpl_dw_length*4 - (addr & 3)
+            addr += cpl_dw_length*4 - (addr & 3)
 
-        if not queue.empty():
-            return queue.get_nowait()
+        plan = tuple(plan)
+        if len(self.cpl_plans) >= 4096:
+            self.cpl_plans.clear()
+        self.cpl_plans[key] = plan
+        return plan
 
-        return None
+    @property
+    def tag_count(self):
+        return self._tag_count
 
-    async def alloc_tag(self):
-        tag_count = min(256, self.tag_count)
+    @tag_count.setter
+    def tag_count(self, value):
+        self._tag_count = value
 
-        while True:
-            tag = self.current_tag
-            for k in range(tag_count):
-                tag = (tag + 1) % tag_count
-                if not self.tag_active[tag]:
-                    self.tag_active[tag] = True
-                    self.current_tag = tag
-                    return tag
+        tag_count = min(256, value)
+
+        if tag_count != self.tag_free_count:
+            # tag count changed; rebuild free list
+            self.tag_free = deque(tag for tag in range(tag_count) if not self.tag_active[tag])
+            self.tag_free_count = tag_count
+
+        # hand any newly available tags to waiters
+        while self.tag_waiters and self.tag_free:
+            tag = self.tag_free.popleft()
+            self.tag_active[tag] = True
+            self._hand_tag(tag)
+
+    async def alloc_tag(self):
+        if self.tag_free:
+            tag = self.tag_free.popleft()
+            self.tag_active[tag] = True
+            return tag
+
+        # no free tags; wait for one to be handed over by release_tag
+        waiter = [Event(), None]
+        self.tag_waiters.append(waiter)
+        try:
+            await waiter[0].wait()
+        except BaseException:
+            # cancelled or killed; don't leave the waiter (or its tag) behind
+            if waiter[1] is None:
+                self.tag_waiters.remove(waiter)
+            else:
+                self.release_tag(waiter[1])
+            raise
+        return waiter[1]
 
-            self.tag_release.clear()
-            await self.tag_release.wait()
+    def _hand_tag(self, tag):
+        # hand an active tag directly to the next waiter
+        waiter = self.tag_waiters.popleft()
+        waiter[1] = tag
+        waiter[0].set()
 
     def release_tag(self, tag):
         assert self.tag_active[tag]
+
+        if self.tag_waiters and tag < self.tag_free_count:
+            self._hand_tag(tag)
+            return
+
         self.tag_active[tag] = False
-        self.tag_release.set()
+        if tag < self.tag_free_count:
+            self.tag_free.append(tag)
+
+    def _handle_cpl(self, tlp):
+        op = self.tag_ops[tlp.tag]
+
+        if op is None or op[2].is_set():
+            self.log.warning("Unexpected completion: tag %d not outstanding: %r", tlp.tag, tlp)
+            return
+
+        req, completions, done = op
+        completions.append(tlp)
+
+        if tlp.status != CplStatus.SC:
+            # bad status
+            done.set()
+        elif req.fmt_type in {TlpType.MEM_READ, TlpType.MEM_READ_64}:
+            # completion for memory read request
+
+            # request completed
+            if tlp.byte_count <= tlp.length*4 - (tlp.lower_address & 0x3):
+                done.set()
+
+            # completion for read request has SC status but no data
+            if tlp.fmt_type in {TlpType.CPL, TlpType.CPL_LOCKED}:
+                done.set()
+
+        else:
+            # completion for other request
+            done.set()
 
     async def perform_posted_operation(self, source, req):
         await source.send(PcieIfFrame.from_tlp(req, self.force_64bit_addr))
 
     async def perform_nonposted_operation(self, source, req, timeout=0, timeout_unit='ns'):
         completions = []
+        done = Event()
 
         req.tag = await self.alloc_tag()
+        self.tag_ops[req.tag] = (req, completions, done)
 
         await source.send(PcieIfFrame.from_tlp(req, self.force_64bit_addr))
 
-        while True:
-            cpl = await self.recv_cpl(req.tag, timeout, timeout_unit)
-
-            if not cpl:
-                break
-
-            completions.append(cpl)
-
-            if cpl.status != CplStatus.SC:
-                # bad status
-                break
-            elif req.fmt_type in {TlpType.MEM_READ, TlpType.MEM_READ_64}:
-                # completion for memory read request
-
-                # request completed
-                if cpl.byte_count <= cpl.length*4 - (cpl.lower_address & 0x3):
-                    break
-
-                # completion for read request has SC status but no data
-                if cpl.fmt_type in {TlpType.CPL, TlpType.CPL_LOCKED}:
+        # completions are collected by the RX completion handler,
+        # which sets done once the request is complete
+        if timeout:
+            while not done.is_set():
+                cpl_count = len(completions)
+                await First(done.wait(), Timer(timeout, timeout_unit))
+                if len(completions) == cpl_count:
+                    # no progress within timeout
                     break
+        else:
+            await done.wait()
 
-            else:
-                # completion for other request
-                break
-
+        self.tag_ops[req.tag] = None
         self.release_tag(req.tag)
 
         return completions
@@ -1608,7 +1973,7 @@ class PcieIfTestDevice:
 
         return bytes(data[:length])
 
-    async def dma_mem_write(self, addr, data, timeout=0, timeout_unit='ns'):
+    def _gen_mem_write_reqs(self, addr, data):
         n = 0
 
         zero_len = len(data) == 0
@@ -1634,21 +1999,65 @@ class PcieIfTestDevice:
             if zero_len:
                 req.first_be = 0
 
-            await self.perform_posted_operation(self.tx_wr_req_tlp_source, req)
+            yield req
 
             n += byte_length
             addr += byte_length
 
-    async def dma_mem_read(self, addr, length, timeout=0, timeout_unit='ns'):
-        data = bytearray()
+    def _update_posted_flow_control(self):
+        source = self.tx_wr_req_tlp_source
+
+        if source.fc is None:
+            if not self.posted_ph_window and not self.posted_pd_window:
+                return
+            source.set_flow_control(PcieIfFlowControl(self.clk))
+
+        source.fc.limit[0] = self.posted_ph_window
+        source.fc.limit[1] = self.posted_pd_window
+        source.fc.latency = self.posted_credit_latency
+
+    async def dma_mem_write(self, addr, data, timeout=0, timeout_unit='ns'):
+        source = self.tx_wr_req_tlp_source
+
+        self._update_posted_flow_control()
+
+        for req in self._gen_mem_write_reqs(addr, data):
+            frame = PcieIfFrame.from_tlp(req, self.force_64bit_addr)
+
+            # keep up to a window of TLPs queued behind the ones holding
+            # credits, so the source never waits on submission
+            pd = (len(frame)+3) // 4
+            while source.queue_occupancy_frames > 0 and (
+                    (self.posted_ph_window and source.queue_occupancy_frames >= self.posted_ph_window) or
+                    (self.posted_pd_window and (source.queue_occupancy_bytes+3) // 4 + pd > self.posted_pd_window)):
+                source.dequeue_event.clear()
+                await source.dequeue_event.wait()
+
+            source._enqueue(frame)
+
+    async def dma_mem_write_bw(self, addr, data, timeout=0, timeout_unit='ns'):
+        # write and wait for transmission, returns bandwidth in bytes/sec of sim time
+        start_time = get_sim_time('ns')
+
+        await self.dma_mem_write(addr, data, timeout, timeout_unit)
+
+        while not self.tx_wr_req_tlp_source.idle():
+            await RisingEdge(self.clk)
+
+        elapsed = get_sim_time('ns') - start_time
+        bw = len(data)*1e9 / elapsed if elapsed else 0.0
+
+        self.log.info("DMA write: %d bytes in %d ns (%.3f MB/s)", len(data), elapsed, bw/1e6)
+
+        return bw
+
+    def _gen_mem_read_reqs(self, addr, length):
         n = 0
 
         zero_len = length <= 0
         if zero_len:
             length = 1
 
-        op_list = []
-
         while n < length:
             req = Tlp()
             if addr > 0xffffffff:
@@ -1671,39 +2080,79 @@ class PcieIfTestDevice:
             if zero_len:
                 req.first_be = 0
 
-            op_list.append((byte_length, cocotb.start_soon(self.perform_nonposted_operation(self.tx_rd_req_tlp_source, req, timeout, timeout_unit))))
+            yield req, byte_length
 
             n += byte_length
             addr += byte_length
 
-        for byte_length, op in op_list:
-            cpl_list = await op.join()
+    def _reassemble_cpls(self, cpl_list, byte_length, buf, pos):
+        # copy completion data for one read request into buf at pos
+        m = 0
+        cpls = iter(cpl_list)
 
-            m = 0
+        while m < byte_length:
+            cpl = next(cpls, None)
+
+            if cpl is None:
+                raise Exception("Timeout")
 
-            while m < byte_length:
-                if not cpl_list:
-                    raise Exception("Timeout")
+            if cpl.status != CplStatus.SC:
+                raise Exception("Unsuccessful completion")
 
-                cpl = cpl_list.pop(0)
+            assert cpl.byte_count+3+(cpl.lower_address & 3) >= cpl.length*4
+            assert cpl.byte_count == max(byte_length - m, 1)
 
-                if cpl.status != CplStatus.SC:
-                    raise Exception("Unsuccessful completion")
+            d = cpl.get_data()
 
-                assert cpl.byte_count+3+(cpl.lower_address & 3) >= cpl.length*4
-                assert cpl.byte_count == max(byte_length - m, 1)
+            offset = cpl.lower_address & 3
+            cnt = min(len(d)-offset, cpl.byte_count, byte_length-m)
+            buf[pos+m:pos+m+cnt] = memoryview(d)[offset:offset+cnt]
 
-                d = cpl.get_data()
+            m += len(d)-offset
 
-                offset = cpl.lower_address & 3
-                data.extend(d[offset:offset+cpl.byte_count])
+    async def dma_mem_read(self, addr, length, timeout=0, timeout_unit='ns'):
+        zero_len = length <= 0
 
-                m += len(d)-offset
+        data = bytearray(max(length, 1))
+
+        op_list = []
+        pos = 0
+
+        for req, byte_length in self._gen_mem_read_reqs(addr, length):
+            op_list.append((pos, byte_length, cocotb.start_soon(self.perform_nonposted_operation(self.tx_rd_req_tlp_source, req, timeout, timeout_unit))))
+            pos += byte_length
+
+        for pos, byte_length, op in op_list:
+            cpl_list = await op.join()
+            self._reassemble_cpls(cpl_list, byte_length, data, pos)
 
         if zero_len:
             return b''
 
-        return bytes(data[:length])
+        return bytes(data)
+
+    async def dma_mem_read_stream(self, addr, length, timeout=0, timeout_unit='ns'):
+        # yields the read data in order, one contiguous chunk per read request;
+        # requests are issued at most tag_count ahead of the consumer
+        if length <= 0:
+            return
+
+        op_list = deque()
+
+        for req, byte_length in self._gen_mem_read_reqs(addr, length):
+            op_list.append((byte_length, cocotb.start_soon(self.perform_nonposted_operation(self.tx_rd_req_tlp_source, req, timeout, timeout_unit))))
+
+            while len(op_list) >= max(self.tag_count, 1):
+                byte_length, op = op_list.popleft()
+                chunk = bytearray(byte_length)
+                self._reassemble_cpls(await op.join(), byte_length, chunk, 0)
+                yield chunk
+
+        while op_list:
+            byte_length, op = op_list.popleft()
+            chunk = bytearray(byte_length)
+            self._reassemble_cpls(await op.join(), byte_length, chunk, 0)
+            yield chunk
 
     async def issue_msi_interrupt(self, addr, data):
         data = data.to_bytes(4, 'little')
@@ -1739,13 +2188,12 @@ class PcieIfTestDevice:
 
             tlp = frame.to_tlp()
 
-            self.log.debug("RX TLP: %s", repr(tlp))
+            self.log.debug("RX TLP: %r", tlp)
 
             if tlp.fmt_type in {TlpType.CPL, TlpType.CPL_DATA, TlpType.CPL_LOCKED, TlpType.CPL_LOCKED_DATA}:
                 self.log.info("Completion")
 
-                self.rx_cpl_queues[tlp.tag].put_nowait(tlp)
-                self.rx_cpl_sync[tlp.tag].set()
+                self._handle_cpl(tlp)
 
             elif tlp.fmt_type == TlpType.IO_READ:
                 self.log.info("IO read")
@@ -1779,7 +2227,7 @@ class PcieIfTestDevice:
                 cpl.byte_count = 4
                 cpl.length = 1
 
-                self.log.debug("Completion: %s", repr(cpl))
+                self.log.debug("Completion: %r", cpl)
                 await self.tx_cpl_tlp_source.send(PcieIfFrame.from_tlp(cpl, self.force_64bit_addr))
 
             elif tlp.fmt_type == TlpType.IO_WRITE:
@@ -1810,7 +2258,7 @@ class PcieIfTestDevice:
                 if start_offset is not None and offset != start_offset:
                     await self.write_region(region, addr+start_offset, data[start_offset:offset])
 
-                self.log.debug("Completion: %s", repr(cpl))
+                self.log.debug("Completion: %r", cpl)
                 await self.tx_cpl_tlp_source.send(PcieIfFrame.from_tlp(cpl, self.force_64bit_addr))
 
             elif tlp.fmt_type in {TlpType.MEM_READ, TlpType.MEM_READ_64}:
@@ -1823,38 +2271,29 @@ class PcieIfTestDevice:
                 length = tlp.length
 
                 # perform read
-                data = bytearray(await self.read_region(region, addr, tlp.length*4))
+                mem = self.region_mem[region]
+                if mem is not None:
+                    # memory-backed region; take one snapshot of the backing store
+                    # so that all completions carry the data as of the read
+                    data = bytes(mem[addr:addr+length*4])
+                else:
+                    data = bytearray(await self.read_region(region, addr, length*4))
 
                 # prepare completion TLP(s)
-                m = 0
-                n = 0
-                addr = tlp.address+tlp.get_first_be_offset()
-                dw_length = tlp.length
-                byte_length = tlp.get_be_byte_count()
-
-                while m < dw_length:
-                    cpl = Tlp.create_completion_data_for_tlp(tlp, PcieId(self.dev_bus_num, self.dev_device_num, 0))
-
-                    cpl_dw_length = dw_length - m
-                    cpl_byte_length = byte_length - n
-                    cpl.byte_count = cpl_byte_length
-                    if cpl_dw_length > 32 << self.dev_max_payload:
-                        # max payload size
-                        cpl_dw_length = 32 << self.dev_max_payload
-                        # RCB align
-                        cpl_dw_length -= (addr & 0x7c) >> 2
-
-                    cpl.lower_address = addr & 0x7f
+                plan = self._get_cpl_plan(tlp.address+tlp.get_first_be_offset(), length, tlp.get_be_byte_count())
+
+                # single completion template, updated for each chunk
+                cpl = Tlp.create_completion_data_for_tlp(tlp, PcieId(self.dev_bus_num, self.dev_device_num, 0))
+
+                for m, cpl_dw_length, byte_count, lower_address in plan:
+                    cpl.byte_count = byte_count
+                    cpl.lower_address = lower_address
 
                     cpl.set_data(data[m*4:(m+cpl_dw_length)*4])
 
-                    self.log.debug("Completion: %s", repr(cpl))
+                    self.log.debug("Completion: %r", cpl)
                     await self.tx_cpl_tlp_source.send(PcieIfFrame.from_tlp(cpl, self.force_64bit_addr))
 
-                    m += cpl_dw_length
-                    n += cpl_dw_length*4 - (addr & 3)
-                    addr += cpl_dw_length*4 - (addr & 3)
-
             elif tlp.fmt_type in {TlpType.MEM_WRITE, TlpType.MEM_WRITE_64}:
                 self.log.info("Memory write")
 
@@ -1869,6 +2308,12 @@ class PcieIfTestDevice:
                 # perform write
                 data = tlp.get_data()
 
+                mem = self.region_mem[region]
+                if mem is not None and mask == 0xf and (length == 1 or tlp.last_be == 0xf):
+                    # memory-backed region with all bytes enabled
+                    mem[addr:addr+length*4] = data
+                    continue
+
                 # first dword
                 for k in range(4):
                     if mask & (1 << k):
@@ -1911,10 +2356,9 @@ class PcieIfTestDevice:
 
             tlp = frame.to_tlp()
 
-            self.log.debug("RX TLP: %s", repr(tlp))
+            self.log.debug("RX TLP: %r", tlp)
 
             if tlp.fmt_type in {TlpType.CPL, TlpType.CPL_DATA, TlpType.CPL_LOCKED, TlpType.CPL_LOCKED_DATA}:
                 self.log.info("Completion")
 
-                self.rx_cpl_queues[tlp.tag].put_nowait(tlp)
-                self.rx_cpl_sync[tlp.tag].set()
+                self._handle_cpl(tlp)
@@ -28,12 +28,12 @@ from cocotbext.axi import AxiLiteBus, AxiLiteRam
 
 
 try:
-    from pcie_if import PcieIfDevice, PcieIfRxBus, PcieIfTxBus
+    from pcie_if import PcieIfDevice, PcieIfTestDevice, PcieIfFlowControl, PcieIfRxBus, PcieIfTxBus
 except ImportError:
     # attempt import from current directory
     sys.path.insert(0, os.path.join(os.path.dirname(__file__)))
     try:
-        from pcie_if import PcieIfDevice, PcieIfRxBus, PcieIfTxBus
+        from pcie_if import PcieIfDevice, PcieIfTestDevice, PcieIfFlowControl, PcieIfRxBus, PcieIfTxBus
     finally:
         del sys.path[0]
 
@@ -93,15 +93,15 @@ class TB(object):
     def set_idle_generator(self, generator=None):
         if generator:
             self.dev.rx_req_tlp_source.set_pause_generator(generator())
-            self.axil_ram.write_if.b_channel.set_pause_generator(generator())
-            self.axil_ram.read_if.r_channel.set_pause_generator(generator())
+            self.axil_ram.write_if.b_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.read_if.r_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
             self.dev.tx_cpl_tlp_sink.set_pause_generator(generator())
-            self.axil_ram.write_if.aw_channel.set_pause_generator(generator())
-            self.axil_ram.write_if.w_channel.set_pause_generator(generator())
-            self.axil_ram.read_if.ar_channel.set_pause_generator(generator())
+            self.axil_ram.write_if.aw_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.write_if.w_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.read_if.ar_channel.set_pause_generator(itertools.cycle(generator()))
 
     async def _run_monitor_stat_err_cor(self):
         while True:
@@ -127,8 +127,64 @@ class TB(object):
         await RisingEdge(self.dut.clk)
 
 
+class TestDevTB(object):
+    # drives the DUT directly from the PcieIfTestDevice requester interfaces
+    def __init__(self, dut):
+        self.dut = dut
+
+        self.log = logging.getLogger("cocotb.tb")
+        self.log.setLevel(logging.DEBUG)
+
+        cocotb.start_soon(Clock(dut.clk, 4, units="ns").start())
+
+        self.dev = PcieIfTestDevice(
+            clk=dut.clk,
+            rst=dut.rst,
+
+            tx_wr_req_tlp_bus=PcieIfRxBus.from_entity(dut.rx_req_tlp),
+            rx_cpl_tlp_bus=PcieIfTxBus.from_entity(dut.tx_cpl_tlp)
+        )
+
+        # AXI
+        self.axil_ram = AxiLiteRam(AxiLiteBus.from_entity(dut.m_axil), dut.clk, dut.rst, size=2**16)
+
+        dut.bus_num.setimmediatevalue(0)
+
+    def set_idle_generator(self, generator=None):
+        if generator:
+            self.dev.tx_wr_req_tlp_source.set_pause_generator(generator())
+
+    def set_backpressure_generator(self, generator=None):
+        if generator:
+            self.dev.rx_cpl_tlp_sink.set_pause_generator(generator())
+
+    async def cycle_reset(self):
+        self.dut.rst.setimmediatevalue(0)
+        await RisingEdge(self.dut.clk)
+        await RisingEdge(self.dut.clk)
+        self.dut.rst.value = 1
+        await RisingEdge(self.dut.clk)
+        await RisingEdge(self.dut.clk)
+        self.dut.rst.value = 0
+        await RisingEdge(self.dut.clk)
+        await RisingEdge(self.dut.clk)
+
+
+class CreditSignal:
+    # stands in for a DUT *_av input, holds the driven value
+    def __init__(self, width):
+        self.width = width
+        self.value = 0
+
+    def __len__(self):
+        return self.width
+
+    def setimmediatevalue(self, value):
+        self.value = value
+
+
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
@@ -299,6 +355,192 @@ async def run_test_bad_ops(dut, idle_inserter=None, backpressure_inserter=None):
     await RisingEdge(dut.clk)
 
 
+@cocotb.test()
+@cocotb.parametrize(
+    ("idle_inserter", [None, cycle_pause]),
+    ("backpressure_inserter", [None, cycle_pause]),
+)
+async def run_test_dma_io_write(dut, idle_inserter=None, backpressure_inserter=None):
+
+    tb = TestDevTB(dut)
+
+    tb.set_idle_generator(idle_inserter)
+    tb.set_backpressure_generator(backpressure_inserter)
+
+    await tb.cycle_reset()
+
+    source = tb.dev.tx_wr_req_tlp_source
+    max_frames = 0
+
+    async def monitor_occupancy():
+        nonlocal max_frames
+        while True:
+            await RisingEdge(dut.clk)
+            max_frames = max(max_frames, source.queue_occupancy_frames)
+
+    monitor_cr = cocotb.start_soon(monitor_occupancy())
+
+    tb.log.info("Test IO write (multiple TLPs)")
+
+    length = 32
+    pcie_addr = 0x1000
+    test_data = bytearray([x % 256 for x in range(length)])
+
+    tb.axil_ram.write(pcie_addr-128, b'\x55'*(len(test_data)+256))
+
+    # IO requests are not supported by the DUT, each one gets a UR completion
+    with assert_raises(Exception, "Unsuccessful completion"):
+        await tb.dev.dma_io_write(pcie_addr, test_data, timeout=10000, timeout_unit='ns')
+
+    # wait for the remaining completions
+    for k in range(1000):
+        if not any(tb.dev.tag_active):
+            break
+        await RisingEdge(dut.clk)
+
+    monitor_cr.kill()
+
+    assert not any(tb.dev.tag_active)
+    assert source.idle()
+
+    # IO writes are held to the source frame limit
+    assert max_frames <= source.queue_occupancy_limit_frames+1
+
+    assert tb.axil_ram.read(pcie_addr-1, len(test_data)+2) == b'\x55'*(len(test_data)+2)
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+@cocotb.test()
+@cocotb.parametrize(
+    ("idle_inserter", [None, cycle_pause]),
+    ("backpressure_inserter", [None, cycle_pause]),
+)
+async def run_test_dma_mem_write(dut, idle_inserter=None, backpressure_inserter=None):
+
+    tb = TestDevTB(dut)
+
+    tb.set_idle_generator(idle_inserter)
+    tb.set_backpressure_generator(backpressure_inserter)
+
+    await tb.cycle_reset()
+
+    # slow credit return, so that a single credit limits throughput
+    tb.dev.posted_credit_latency = 64
+
+    length = 4096
+    pcie_addr = 0x1000
+
+    bw = {}
+
+    for window in [1, 8]:
+        tb.log.info("Test DMA memory write (posted window %d)", window)
+
+        tb.dev.posted_ph_window = window
+
+        test_data = bytearray([(x+window) % 256 for x in range(length)])
+
+        tb.axil_ram.write(pcie_addr-128, b'\x55'*(len(test_data)+256))
+
+        bw[window] = await tb.dev.dma_mem_write_bw(pcie_addr, test_data)
+
+        # wait for the AXI lite writes to complete
+        for k in range(10000):
+            if tb.axil_ram.read(pcie_addr+length-4, 5) == test_data[-4:]+b'\x55':
+                break
+            await RisingEdge(dut.clk)
+
+        assert tb.axil_ram.read(pcie_addr-1, len(test_data)+2) == b'\x55'+test_data+b'\x55'
+
+    tb.log.info("Posted window bandwidth: %s", bw)
+
+    assert bw[8] > bw[1]
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
+@cocotb.test()
+async def run_test_cpl_flow_control(dut):
+
+    tb = TestDevTB(dut)
+
+    await tb.cycle_reset()
+
+    sink = tb.dev.rx_cpl_tlp_sink
+
+    # single completion header credit, returned slowly
+    latency = 32
+    cplh_av = CreditSignal(8)
+    cpld_av = CreditSignal(12)
+    fc = PcieIfFlowControl(dut.clk, cplh=1, cpld=64, latency=latency, cplh_av=cplh_av, cpld_av=cpld_av)
+    sink.set_flow_control(fc)
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+    assert cplh_av.value == 1
+    assert cpld_av.value == 64
+
+    cplh_av_values = set()
+    max_consumed = 0
+    held_cycles = 0
+    cpl_cycles = []
+
+    async def monitor():
+        nonlocal max_consumed, held_cycles
+        cycle = 0
+        while True:
+            await RisingEdge(dut.clk)
+            cycle += 1
+            cplh_av_values.add(cplh_av.value)
+            max_consumed = max(max_consumed, fc.consumed[4])
+            valid = int(sink.bus.valid.value)
+            if valid and not int(sink.bus.ready.value):
+                held_cycles += 1
+            elif valid and int(sink.bus.eop.value):
+                assert bin(valid & int(sink.bus.eop.value)).count('1') == 1
+                cpl_cycles.append(cycle)
+
+    monitor_cr = cocotb.start_soon(monitor())
+
+    tb.log.info("Test completion flow control")
+
+    # each IO write gets a UR completion from the DUT
+    with assert_raises(Exception, "Unsuccessful completion"):
+        await tb.dev.dma_io_write(0x1000, bytearray(32), timeout=10000, timeout_unit='ns')
+
+    for k in range(1000):
+        if not any(tb.dev.tag_active):
+            break
+        await RisingEdge(dut.clk)
+
+    for k in range(latency+4):
+        await RisingEdge(dut.clk)
+
+    monitor_cr.kill()
+
+    tb.log.info("Completions at cycles %s, held back for %d cycles", cpl_cycles, held_cycles)
+
+    assert not any(tb.dev.tag_active)
+    assert len(cpl_cycles) == 8
+
+    # the credit ran out and came back, and the sink never overran the pool
+    assert cplh_av_values == {0, 1}
+    assert max_consumed <= 1
+    assert cplh_av.value == 1
+    assert cpld_av.value == 64
+
+    # completions were held back until the credit returned
+    assert held_cycles > 0
+    for a, b in zip(cpl_cycles, cpl_cycles[1:]):
+        assert b - a >= latency
+
+    await RisingEdge(dut.clk)
+    await RisingEdge(dut.clk)
+
+
 # cocotb-test
 
 tests_dir = os.path.abspath(os.path.dirname(__file__))
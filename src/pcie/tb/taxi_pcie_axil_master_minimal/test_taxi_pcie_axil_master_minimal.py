@@ -92,15 +92,15 @@ class TB(object):
     def set_idle_generator(self, generator=None):
         if generator:
             self.dev.rx_req_tlp_source.set_pause_generator(generator())
-            self.axil_ram.write_if.b_channel.set_pause_generator(generator())
-            self.axil_ram.read_if.r_channel.set_pause_generator(generator())
+            self.axil_ram.write_if.b_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.read_if.r_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
             self.dev.tx_cpl_tlp_sink.set_pause_generator(generator())
-            self.axil_ram.write_if.aw_channel.set_pause_generator(generator())
-            self.axil_ram.write_if.w_channel.set_pause_generator(generator())
-            self.axil_ram.read_if.ar_channel.set_pause_generator(generator())
+            self.axil_ram.write_if.aw_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.write_if.w_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_ram.read_if.ar_channel.set_pause_generator(itertools.cycle(generator()))
 
     async def _run_monitor_stat_err_cor(self):
         while True:
@@ -127,7 +127,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()
@@ -73,14 +73,14 @@ class TB(object):
 
     def set_idle_generator(self, generator=None):
         if generator:
-            self.axil_master.write_if.aw_channel.set_pause_generator(generator())
-            self.axil_master.write_if.w_channel.set_pause_generator(generator())
-            self.axil_master.read_if.ar_channel.set_pause_generator(generator())
+            self.axil_master.write_if.aw_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_master.write_if.w_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_master.read_if.ar_channel.set_pause_generator(itertools.cycle(generator()))
 
     def set_backpressure_generator(self, generator=None):
         if generator:
-            self.axil_master.write_if.b_channel.set_pause_generator(generator())
-            self.axil_master.read_if.r_channel.set_pause_generator(generator())
+            self.axil_master.write_if.b_channel.set_pause_generator(itertools.cycle(generator()))
+            self.axil_master.read_if.r_channel.set_pause_generator(itertools.cycle(generator()))
             self.tlp_sink.set_pause_generator(generator())
 
     async def cycle_reset(self):
@@ -96,7 +96,7 @@ class TB(object):
 
 
 def cycle_pause():
-    return itertools.cycle([1, 1, 1, 0])
+    return [1, 1, 1, 0]
 
 
 @cocotb.test()